@@ -65,7 +65,7 @@ const BrainTumorDetection = () => {
       const formData = new FormData();
       formData.append('file', selectedFile);
 
-      const response = await fetch('http://localhost:5002/', {
+      const response = await fetch('http://localhost:5002/?mode=sync', {
         method: 'POST',
         body: formData,
       });
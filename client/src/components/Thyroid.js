@@ -1,4 +1,7 @@
-import React, { useState } from 'react';
+import React, { useEffect, useRef, useState } from 'react';
+
+const API_URL = 'http://localhost:5003';
+const EXPLANATION_UNAVAILABLE = '<p>Unable to generate explanation at this time.</p>';
 
 const ThyroidApp = () => {
   const [formData, setFormData] = useState({
@@ -25,6 +28,7 @@ const ThyroidApp = () => {
   const [dietRecommendations, setDietRecommendations] = useState(null);
   const [loading, setLoading] = useState(false);
   const [error, setError] = useState(null);
+  const jobStream = useRef(null);
   
   const handleChange = (e) => {
     const { name, value } = e.target;
@@ -44,7 +48,7 @@ const ThyroidApp = () => {
     setDietRecommendations(null);
     
     try {
-      const response = await fetch('http://localhost:5003/api/predict', {
+      const response = await fetch(`${API_URL}/api/predict`, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -58,6 +62,9 @@ const ThyroidApp = () => {
         setPrediction(data.prediction);
         setExplanation(data.explanation);
         setDietRecommendations(data.dietRecommendations);
+        if (data.streamUrl) {
+          followJob(data.streamUrl);
+        }
       } else {
         setError(data.error || 'Unknown error occurred');
       }
@@ -68,6 +75,29 @@ const ThyroidApp = () => {
       setLoading(false);
     }
   };
+
+  // The explanation and diet advice arrive as server-sent events after the prediction
+  const followJob = (streamUrl) => {
+    if (jobStream.current) {
+      jobStream.current.close();
+    }
+    const source = new EventSource(`${API_URL}${streamUrl}`);
+    jobStream.current = source;
+    source.addEventListener('explanation', (event) => {
+      const part = JSON.parse(event.data);
+      setExplanation(part.status === 'done' ? part.value : EXPLANATION_UNAVAILABLE);
+    });
+    source.addEventListener('dietRecommendations', (event) => {
+      const part = JSON.parse(event.data);
+      if (part.status === 'done') {
+        setDietRecommendations(part.value);
+      }
+    });
+    source.addEventListener('done', () => source.close());
+    source.onerror = () => source.close();
+  };
+
+  useEffect(() => () => jobStream.current && jobStream.current.close(), []);
   
   const cardStyle = {
     boxShadow: '0 4px 6px rgba(0, 0, 0, 0.1)',
@@ -0,0 +1,309 @@
+"""
+Buffered, asynchronous audit log of predictions.
+
+Request handlers call `audit.record(...)` with plain values (inputs, outputs,
+model version, stage timings). The record is only put on a bounded queue;
+a background thread serializes queued records in batches and appends them
+as NDJSON to segment files named <service>-<timestamp>-<pid>-<n>.ndjson under
+AUDIT_DIR. Each process writes its own segments, so pre-forked workers never
+interleave writes. A segment is closed once it reaches AUDIT_MAX_MB, and
+only the newest AUDIT_MAX_FILES segments per service are kept; a process
+only prunes its own closed segments and those of processes that have exited,
+never a segment another live worker may still be appending to.
+
+serve.py workers exit with os._exit, which skips atexit, so their SIGTERM
+handler calls close_all() to write out whatever is still queued.
+
+The queue is bounded both by record count (AUDIT_QUEUE_SIZE) and by the
+estimated in-memory size of the queued records (AUDIT_QUEUE_MB). When the
+record count is at its cap, AUDIT_POLICY decides what happens:
+  - drop (the default): the record is discarded and counted in stats()
+  - block: the request waits up to AUDIT_BLOCK_MS for space, then drops
+A record that would take the queue over its byte cap is always dropped.
+Batch endpoints should record a digest and row count of their inputs
+(see batch_digest()) rather than the raw rows.
+"""
+import atexit
+import glob
+import hashlib
+import json
+import math
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+def _json_default(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (set, tuple)):
+        return list(value)
+    return str(value)
+
+
+def _clean(value):
+    # Strict JSON has no NaN; audit readers get null instead
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if isinstance(value, dict):
+        return {key: _clean(v) for key, v in value.items()}
+    if isinstance(value, list):
+        return [_clean(v) for v in value]
+    if isinstance(value, np.ndarray) and value.dtype.kind == 'f':
+        return _clean(value.tolist())
+    return value
+
+
+def estimate_bytes(value):
+    """Rough in-memory size of a record value; long lists are sampled, not walked."""
+    if isinstance(value, np.ndarray):
+        return value.nbytes + 112
+    if isinstance(value, (str, bytes)):
+        return len(value) + 49
+    if isinstance(value, dict):
+        return 64 + sum(estimate_bytes(key) + estimate_bytes(v) for key, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        if not value:
+            return 56
+        first = next(iter(value))
+        return 56 + len(value) * (8 + estimate_bytes(first))
+    return 32
+
+
+def batch_digest(value):
+    """Short content digest of a batch input, for audit records that must not carry the rows."""
+    if isinstance(value, np.ndarray):
+        data = np.ascontiguousarray(value).tobytes()
+    else:
+        data = json.dumps(value, default=_json_default, sort_keys=True).encode()
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+def _segment_pid(path):
+    # <service>-<date>-<time>-<pid>-<n>.ndjson
+    try:
+        return int(os.path.basename(path)[:-len('.ndjson')].rsplit('-', 2)[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# Every enabled log in this process, for close_all()
+_logs = []
+
+
+def close_all(timeout=5.0):
+    """Flush and close every audit log in this process."""
+    for log in list(_logs):
+        log.close(timeout)
+
+
+class AuditLog:
+    def __init__(self, directory, service, max_queue=10000, batch_size=256, flush_interval=1.0,
+                 max_bytes=64 * 2**20, max_files=20, policy='drop', block_ms=50.0, enabled=True,
+                 max_queue_bytes=64 * 2**20):
+        self.directory = directory
+        self.service = service
+        self.max_queue = max_queue
+        self.max_queue_bytes = max_queue_bytes
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.policy = policy
+        self.block_timeout = block_ms / 1000.0
+        self.enabled = enabled
+
+        self.recorded = 0
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+            self._start()
+            _logs.append(self)
+            atexit.register(self.close)
+            # The writer thread doesn't survive fork; each worker gets its own
+            os.register_at_fork(after_in_child=self._start)
+
+    def _start(self):
+        self._queue = queue.Queue(maxsize=self.max_queue)
+        self._file = None
+        self._path = None
+        self._file_bytes = 0
+        # Records queued or taken off the queue but not yet written or dropped
+        self._pending = 0
+        # Estimated size of those records
+        self._pending_bytes = 0
+        self._segment = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._flushed = threading.Condition()
+        self._writer = threading.Thread(target=self._run, name=f'{self.service}-audit', daemon=True)
+        self._writer.start()
+
+    def record(self, **fields):
+        """Queue one audit record. Returns False if it was dropped."""
+        if not self.enabled:
+            return False
+        fields['ts'] = time.time()
+        fields['service'] = self.service
+        size = estimate_bytes(fields)
+        with self._lock:
+            if self._pending_bytes + size > self.max_queue_bytes:
+                self.dropped += 1
+                return False
+            # Reserve the bytes before queueing so the writer can't release them first
+            self._pending += 1
+            self._pending_bytes += size
+        try:
+            if self.policy == 'block':
+                self._queue.put((fields, size), timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait((fields, size))
+        except queue.Full:
+            with self._lock:
+                self._pending -= 1
+                self._pending_bytes -= size
+                self.dropped += 1
+            return False
+        with self._lock:
+            self.recorded += 1
+        return True
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                if self._closed:
+                    return
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch):
+        try:
+            data = ''.join(json.dumps(_clean(entry), default=_json_default, separators=(',', ':')) + '\n'
+                           for entry, _ in batch).encode()
+            with self._lock:
+                if self._closed:
+                    # close() gave up waiting for this batch
+                    self.dropped += len(batch)
+                    return
+                if self._file is None or self._file_bytes >= self.max_bytes:
+                    self._rotate()
+                self._file.write(data)
+                self._file.flush()
+                self._file_bytes += len(data)
+                self.written += len(batch)
+        except Exception as e:
+            self.errors += 1
+            print(f"Error writing {len(batch)} audit records: {e}")
+        finally:
+            with self._lock:
+                self._pending -= len(batch)
+                self._pending_bytes -= sum(size for _, size in batch)
+            with self._flushed:
+                self._flushed.notify_all()
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+        self._segment += 1
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        pid = os.getpid()
+        self._path = os.path.join(self.directory, f'{self.service}-{stamp}-{pid}-{self._segment}.ndjson')
+        self._file = open(self._path, 'ab')
+        self._file_bytes = 0
+        self._prune(pid)
+
+    def _prune(self, pid):
+        segments = []
+        for path in glob.glob(os.path.join(self.directory, f'{self.service}-*.ndjson')):
+            try:
+                segments.append((os.path.getmtime(path), path))
+            except OSError:
+                pass  # pruned by another process meanwhile
+        segments.sort()
+        for _, old in segments[:-self.max_files]:
+            owner = _segment_pid(old)
+            if old == self._path or owner is None or (owner != pid and _process_alive(owner)):
+                continue
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+    def flush(self, timeout=5.0):
+        """Wait until everything queued so far has been written."""
+        if not self.enabled:
+            return
+        deadline = time.monotonic() + timeout
+        with self._flushed:
+            while self._pending > 0 and time.monotonic() < deadline:
+                self._flushed.wait(timeout=0.1)
+
+    def close(self, timeout=5.0):
+        if not self.enabled:
+            return
+        self.flush(timeout)
+        # A signal handler may interrupt a thread holding the lock; don't hang on it
+        if not self._lock.acquire(timeout=timeout):
+            return
+        try:
+            self._closed = True
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'queue_depth': self._queue.qsize() if self.enabled else 0,
+            'max_queue': self.max_queue,
+            'queue_bytes': self._pending_bytes if self.enabled else 0,
+            'max_queue_bytes': self.max_queue_bytes,
+            'recorded': self.recorded,
+            'written': self.written,
+            'dropped': self.dropped,
+            'errors': self.errors,
+        }
+
+
+def create_audit_log(service):
+    """Build an AuditLog from the AUDIT_* environment variables."""
+    return AuditLog(
+        os.environ.get('AUDIT_DIR', 'audit'),
+        service,
+        max_queue=int(os.environ.get('AUDIT_QUEUE_SIZE', 10000)),
+        batch_size=int(os.environ.get('AUDIT_BATCH_SIZE', 256)),
+        flush_interval=float(os.environ.get('AUDIT_FLUSH_SECONDS', 1.0)),
+        max_bytes=int(float(os.environ.get('AUDIT_MAX_MB', 64)) * 2**20),
+        max_files=int(os.environ.get('AUDIT_MAX_FILES', 20)),
+        policy=os.environ.get('AUDIT_POLICY', 'drop'),
+        block_ms=float(os.environ.get('AUDIT_BLOCK_MS', 50)),
+        enabled=os.environ.get('AUDIT_ENABLED', '1') == '1',
+        max_queue_bytes=int(float(os.environ.get('AUDIT_QUEUE_MB', 64)) * 2**20),
+    )
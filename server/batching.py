@@ -0,0 +1,142 @@
+import os
+import threading
+import queue
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class _PendingRequest:
+    def __init__(self, item):
+        self.item = item
+        self.enqueued_at = time.perf_counter()
+        self.future = Future()
+
+
+class MicroBatcher:
+    """
+    Gathers concurrent single-sample requests into one batch and runs a
+    single forward pass for all of them.
+
+    predict_fn receives a stacked array of shape (batch, ...) and must return
+    an array whose rows line up with the inputs. Each caller of submit() gets
+    back its own row.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=16, max_wait_ms=5.0, name='batcher'):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.name = name
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+
+        # Metrics for tuning max_batch_size / max_wait_ms
+        self._batch_sizes = Counter()
+        self._recent_waits = deque(maxlen=1000)
+        self._total_requests = 0
+        self._total_batches = 0
+        self._total_wait = 0.0
+        self._max_wait_seen = 0.0
+        self._total_predict_time = 0.0
+
+        self._start_worker()
+
+        # Threads don't survive fork; pre-forked workers need their own
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _start_worker(self):
+        self._worker = threading.Thread(target=self._run, name=f'{self.name}-worker', daemon=True)
+        self._worker.start()
+
+    def _after_fork(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._start_worker()
+
+    def submit(self, item, timeout=None):
+        """Queue one sample and block until its prediction row is ready."""
+        request = _PendingRequest(item)
+        self._queue.put(request)
+        return request.future.result(timeout=timeout)
+
+    def _collect_batch(self):
+        first = self._queue.get()
+        batch = [first]
+        deadline = first.enqueued_at + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining <= 0:
+                    # Still take whatever is already waiting, just don't block for more
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            started = time.perf_counter()
+
+            try:
+                inputs = np.stack([request.item for request in batch])
+                outputs = self.predict_fn(inputs)
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            finally:
+                self._record(batch, started)
+
+            for request, row in zip(batch, outputs):
+                request.future.set_result(row)
+
+    def _record(self, batch, started):
+        finished = time.perf_counter()
+        with self._lock:
+            self._total_batches += 1
+            self._total_requests += len(batch)
+            self._batch_sizes[len(batch)] += 1
+            self._total_predict_time += finished - started
+            for request in batch:
+                wait = started - request.enqueued_at
+                self._total_wait += wait
+                self._recent_waits.append(wait)
+                if wait > self._max_wait_seen:
+                    self._max_wait_seen = wait
+
+    def stats(self):
+        """Return per-batch size and queue-wait metrics as a plain dict."""
+        with self._lock:
+            waits = sorted(self._recent_waits)
+            batches = self._total_batches
+            requests = self._total_requests
+
+            def percentile(p):
+                if not waits:
+                    return 0.0
+                return waits[min(len(waits) - 1, int(p * len(waits)))] * 1000.0
+
+            return {
+                'name': self.name,
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000.0,
+                'queue_depth': self._queue.qsize(),
+                'total_requests': requests,
+                'total_batches': batches,
+                'mean_batch_size': requests / batches if batches else 0.0,
+                'batch_size_histogram': {str(size): count for size, count in sorted(self._batch_sizes.items())},
+                'mean_queue_wait_ms': (self._total_wait / requests * 1000.0) if requests else 0.0,
+                'p50_queue_wait_ms': percentile(0.50),
+                'p95_queue_wait_ms': percentile(0.95),
+                'max_queue_wait_ms': self._max_wait_seen * 1000.0,
+                'mean_batch_predict_ms': (self._total_predict_time / batches * 1000.0) if batches else 0.0,
+            }
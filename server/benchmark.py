@@ -0,0 +1,555 @@
+"""
+Benchmark suite for the diagnostic services.
+
+Load tests drive the HTTP endpoints at a fixed concurrency:
+
+    python benchmark.py load --spawn --concurrency 8 --requests 400 -o results.json
+
+With --spawn the three services are started through serve.py with the LLM
+stubbed (LLM_BACKEND=stub) and throwaway caches, and their peak RSS is
+reported. Without it, the --brain-url/--lung-url/--thyroid-url services must
+already be running; pass --pid to include their memory.
+
+Micro-benchmarks time the in-process hot paths (predict_tumor,
+preprocess_input, ANNnet forward, ThyroidAssessmentModel.predict):
+
+    python benchmark.py micro --iterations 200 -o micro.json
+
+Every run writes a JSON report with p50/p95/p99 latency, throughput and peak
+RSS. Two reports can be compared, for example between commits:
+
+    python benchmark.py compare before.json after.json
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+IMAGE_DIRS = [os.path.join(HERE, '..', 'testPics'), os.path.join(HERE, 'uploads')]
+IMAGE_PATTERNS = ('*.jpg', '*.jpeg', '*.png')
+
+SERVICES = {
+    # name: (serve.py app, port, health path)
+    'brain': ('brain', 5002, '/health'),
+    'lung': ('lung', 5004, '/health'),
+    'thyroid': ('thyroid', 5003, '/api/health'),
+}
+
+LUNG_SYMPTOMS = ['SMOKING', 'YELLOW_FINGERS', 'ANXIETY', 'PEER_PRESSURE', 'CHRONIC DISEASE',
+                 'FATIGUE', 'ALLERGY', 'WHEEZING', 'ALCOHOL', 'COUGHING', 'SHORTNESS OF BREATH',
+                 'SWALLOWING DIFFICULTY', 'CHEST PAIN']
+
+THYROID_FLAGS = ['on_thyroxine', 'query_on_thyroxine', 'on_antithyroid_medication', 'sick',
+                 'pregnant', 'thyroid_surgery', 'I131_treatment', 'query_hypothyroid',
+                 'query_hyperthyroid', 'tumor', 'psych']
+
+ASSESS_SYMPTOMS = ['fatigue', 'weight_change', 'cold_sensitivity', 'hair_loss',
+                   'dry_skin', 'mood_changes', 'neck_swelling', 'heart_rate_changes']
+
+
+# ---------------------------------------------------------------- reporting
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * p
+    lower = int(k)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (k - lower)
+
+
+def summarize(latencies, elapsed, errors=0):
+    """Latency percentiles in milliseconds and throughput in successful calls per second."""
+    values = sorted(latencies)
+    return {
+        'count': len(values),
+        'errors': errors,
+        'elapsed_seconds': elapsed,
+        'throughput_per_second': len(values) / elapsed if elapsed > 0 else 0.0,
+        'mean_ms': sum(values) / len(values) * 1000.0 if values else 0.0,
+        'p50_ms': percentile(values, 0.50) * 1000.0,
+        'p95_ms': percentile(values, 0.95) * 1000.0,
+        'p99_ms': percentile(values, 0.99) * 1000.0,
+        'max_ms': values[-1] * 1000.0 if values else 0.0,
+    }
+
+
+def self_peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def process_peak_rss_bytes(pid):
+    """Peak RSS (VmHWM) of pid plus all of its descendants, or None if unreadable."""
+    children = {}
+    for stat_path in glob.glob('/proc/[0-9]*/stat'):
+        try:
+            with open(stat_path) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            children.setdefault(int(fields[1]), []).append(int(stat_path.split('/')[2]))
+        except (OSError, IndexError, ValueError):
+            continue
+
+    total, pending, found = 0, [pid], False
+    while pending:
+        current = pending.pop()
+        pending.extend(children.get(current, []))
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        total += int(line.split()[1]) * 1024
+                        found = True
+        except OSError:
+            continue
+    return total if found else None
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=HERE,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report_header(kind, args):
+    return {
+        'kind': kind,
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'config': {key: value for key, value in vars(args).items() if key != 'func'},
+        'results': {},
+    }
+
+
+def write_report(report, output):
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+        print(f"Wrote {output}", file=sys.stderr)
+    else:
+        print(text)
+
+
+def print_summary(name, summary):
+    print(f"{name:<24} n={summary['count']:<6} err={summary['errors']:<4} "
+          f"p50={summary['p50_ms']:8.2f}ms p95={summary['p95_ms']:8.2f}ms "
+          f"p99={summary['p99_ms']:8.2f}ms {summary['throughput_per_second']:9.1f}/s",
+          file=sys.stderr)
+
+
+# ---------------------------------------------------------------- payloads
+
+def load_images():
+    images = []
+    for folder in IMAGE_DIRS:
+        for pattern in IMAGE_PATTERNS:
+            for path in sorted(glob.glob(os.path.join(folder, pattern))):
+                with open(path, 'rb') as f:
+                    images.append((os.path.basename(path), f.read()))
+    if not images:
+        raise SystemExit(f"No benchmark images found in {', '.join(IMAGE_DIRS)}")
+    return images
+
+
+def lung_record(rng):
+    record = {'GENDER': rng.choice(['M', 'F']), 'AGE': rng.randint(20, 85)}
+    record.update({name: rng.choice([1, 2]) for name in LUNG_SYMPTOMS})
+    return record
+
+
+def thyroid_record(rng):
+    record = {
+        'age': str(rng.randint(18, 90)),
+        'sex': rng.choice(['0', '1']),
+        'TSH': f"{rng.uniform(0.1, 12):.2f}",
+        'T3': f"{rng.uniform(0.5, 4):.2f}",
+        'TT4': rng.choice(['', f"{rng.uniform(40, 200):.1f}"]),
+    }
+    record.update({name: rng.choice(['0', '1', '']) for name in THYROID_FLAGS})
+    return record
+
+
+def assess_record(rng):
+    return {name: rng.randint(0, 1) for name in ASSESS_SYMPTOMS}
+
+
+def multipart(field, filename, data):
+    boundary = uuid.uuid4().hex
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n').encode() + data + f'\r\n--{boundary}--\r\n'.encode()
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+def json_body(payload):
+    return json.dumps(payload).encode(), 'application/json'
+
+
+def build_targets(args, rng):
+    """Return name -> (url, list of (body, content type)) for the selected targets."""
+    count = max(args.payloads, 1)
+    query = '?mode=sync' if args.mode == 'sync' else ''
+    targets = {}
+
+    if 'brain' in args.targets:
+        images = load_images()
+        if not args.repeat_images:
+            # Trailing bytes after the image data change the content hash but not the
+            # decoded pixels, so each request misses the prediction cache and runs inference
+            images = [(name, data + b'\0' + str(i).encode())
+                      for i, (name, data) in enumerate(images[j % len(images)]
+                                                       for j in range(args.requests + args.warmup))]
+        targets['brain'] = (args.brain_url.rstrip('/') + '/' + query,
+                            [multipart('file', name, data) for name, data in images])
+    if 'lung' in args.targets:
+        targets['lung'] = (args.lung_url.rstrip('/') + '/predict_form',
+                           [json_body(lung_record(rng)) for _ in range(count)])
+    if 'thyroid' in args.targets:
+        targets['thyroid'] = (args.thyroid_url.rstrip('/') + '/api/predict' + query,
+                              [json_body(thyroid_record(rng)) for _ in range(count)])
+    if 'assess' in args.targets:
+        targets['assess'] = (args.thyroid_url.rstrip('/') + '/api/assess',
+                             [json_body(assess_record(rng)) for _ in range(count)])
+    return targets
+
+
+# ---------------------------------------------------------------- load tests
+
+def post(url, body, content_type, timeout):
+    request = urllib.request.Request(url, data=body, method='POST', headers={'Content-Type': content_type})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        response.read()
+        return response.status
+
+
+def drive(url, payloads, total, concurrency, timeout, start=0):
+    """
+    Send total requests with concurrency workers, using payloads from index
+    start on (wrapping around); return (latencies, errors, elapsed).
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def worker():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            body, content_type = payloads[(start + i) % len(payloads)]
+            started = time.perf_counter()
+            try:
+                post(url, body, content_type, timeout)
+            except (urllib.error.URLError, OSError) as e:
+                with lock:
+                    errors[0] += 1
+                    if errors[0] == 1:
+                        print(f"First error for {url}: {e}", file=sys.stderr)
+                continue
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+    return latencies, errors[0], time.perf_counter() - started
+
+
+def wait_for(url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=2) as response:
+                if response.status == 200:
+                    return True
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.5)
+    return False
+
+
+def spawn_services(args, workdir):
+    """Start the services through serve.py with the stub LLM; return name -> Popen."""
+    env = dict(os.environ)
+    env.update({
+        'LLM_BACKEND': 'stub',
+        'LLM_STUB_LATENCY_MS': str(args.stub_latency_ms),
+        'EXPLANATION_CACHE_PATH': '',
+        'THYROID_EXPLANATION_CACHE_PATH': '',
+        'DIET_CACHE_PATH': '',
+        'PREDICTION_CACHE_PATH': os.path.join(workdir, 'prediction_cache.db'),
+        'BRAIN_JOB_STORE_PATH': os.path.join(workdir, 'brain_jobs.db'),
+        'THYROID_JOB_STORE_PATH': os.path.join(workdir, 'thyroid_jobs.db'),
+        'SAVE_UPLOADS': '0',
+    })
+
+    needed = {name for name in args.targets if name in ('brain', 'lung')}
+    if {'thyroid', 'assess'} & set(args.targets):
+        needed.add('thyroid')
+
+    processes = {}
+    for name in sorted(needed):
+        app, port, health = SERVICES[name]
+        processes[name] = subprocess.Popen(
+            [sys.executable, os.path.join(HERE, 'serve.py'), app, '--host', '127.0.0.1',
+             '--port', str(port), '--workers', str(args.workers)],
+            cwd=HERE, env=env)
+        setattr(args, f'{name}_url', f'http://127.0.0.1:{port}')
+
+    for name, process in processes.items():
+        _, port, health = SERVICES[name]
+        if not wait_for(f'http://127.0.0.1:{port}{health}', args.startup_timeout):
+            stop_services(processes)
+            raise SystemExit(f"{name} did not become healthy within {args.startup_timeout}s")
+    return processes
+
+
+def stop_services(processes):
+    for process in processes.values():
+        process.terminate()
+    for process in processes.values():
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def run_load(args):
+    rng = random.Random(args.seed)
+    report = report_header('load', args)
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    processes = spawn_services(args, workdir) if args.spawn else {}
+    pids = {name: process.pid for name, process in processes.items()}
+    for spec in args.pid:
+        name, _, pid = spec.partition('=')
+        pids[name] = int(pid)
+
+    try:
+        targets = build_targets(args, rng)
+        for name, (url, payloads) in targets.items():
+            # Warm up model loading and caches before measuring; the measured run
+            # starts after the warmup payloads so it doesn't resend them
+            drive(url, payloads, args.warmup, args.concurrency, args.timeout)
+            latencies, errors, elapsed = drive(url, payloads, args.requests, args.concurrency, args.timeout,
+                                               start=args.warmup)
+            summary = summarize(latencies, elapsed, errors)
+            summary.update({'url': url, 'concurrency': args.concurrency})
+            report['results'][name] = summary
+            print_summary(name, summary)
+
+        report['peak_rss_bytes'] = {name: process_peak_rss_bytes(pid) for name, pid in pids.items()}
+        report['peak_rss_bytes']['client'] = self_peak_rss_bytes()
+    finally:
+        stop_services(processes)
+
+    write_report(report, args.output)
+
+
+# ---------------------------------------------------------------- micro-benchmarks
+
+def time_calls(fn, iterations, warmup):
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        t = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - t)
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def micro_predict_tumor(args, rng):
+    import brain
+
+    images = [data for _, data in load_images()]
+    cycle = iter(range(sys.maxsize))
+    return {'predict_tumor': lambda: brain.predict_tumor(images[next(cycle) % len(images)])}
+
+
+def micro_lung(args, rng):
+    import torch
+    import lung
+    from lung_model import ANNnet
+
+    record = lung_record(rng)
+    records = [lung_record(rng) for _ in range(args.batch_size)]
+
+    net = ANNnet()
+    if os.path.exists('trained_model.pth'):
+        net.load_state_dict(torch.load('trained_model.pth', map_location=torch.device('cpu')))
+    net.eval()
+    engine = lung.get_form_model()
+    single = lung.preprocess_input(record)
+    batch = lung.preprocess_input(records)
+
+    def forward(model, inputs):
+        def call():
+            with torch.no_grad():
+                model(inputs)
+        return call
+
+    benchmarks = {
+        'preprocess_input': lambda: lung.preprocess_input(record),
+        f'preprocess_input_x{args.batch_size}': lambda: lung.preprocess_input(records),
+        'annnet_forward': forward(net, single),
+        f'annnet_forward_x{args.batch_size}': forward(net, batch),
+    }
+    if engine is not None:
+        benchmarks['engine_forward'] = forward(engine, single)
+        benchmarks[f'engine_forward_x{args.batch_size}'] = forward(engine, batch)
+    return benchmarks
+
+
+def micro_assessment(args, rng):
+    from thyroid_assessment import get_assessment_model
+
+    model = get_assessment_model()
+    symptoms = [assess_record(rng) for _ in range(64)]
+    cycle = iter(range(sys.maxsize))
+    return {'assessment_predict': lambda: model.predict(symptoms[next(cycle) % len(symptoms)])}
+
+
+MICRO_SUITES = {
+    'brain': micro_predict_tumor,
+    'lung': micro_lung,
+    'assess': micro_assessment,
+}
+
+
+def run_micro(args):
+    # Keep the LLM offline and leave no caches behind
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    os.environ.setdefault('LLM_BACKEND', 'stub')
+    os.environ.setdefault('LLM_STUB_LATENCY_MS', str(args.stub_latency_ms))
+    os.environ.setdefault('LLM_STUB_JITTER_MS', '0')
+    os.environ.setdefault('EXPLANATION_CACHE_PATH', '')
+    os.environ.setdefault('PREDICTION_CACHE_PATH', os.path.join(workdir, 'prediction_cache.db'))
+    os.chdir(HERE)
+    sys.path.insert(0, HERE)
+
+    rng = random.Random(args.seed)
+    report = report_header('micro', args)
+    for suite in args.targets:
+        if suite not in MICRO_SUITES:
+            continue
+        try:
+            benchmarks = MICRO_SUITES[suite](args, rng)
+        except ImportError as e:
+            print(f"Skipping {suite}: {e}", file=sys.stderr)
+            report['results'][suite] = {'skipped': str(e)}
+            continue
+
+        for name, fn in benchmarks.items():
+            summary = time_calls(fn, args.iterations, args.warmup)
+            summary['peak_rss_bytes'] = self_peak_rss_bytes()
+            report['results'][name] = summary
+            print_summary(name, summary)
+
+    report['peak_rss_bytes'] = {'process': self_peak_rss_bytes()}
+    write_report(report, args.output)
+
+
+# ---------------------------------------------------------------- comparison
+
+COMPARE_FIELDS = ('p50_ms', 'p95_ms', 'p99_ms', 'throughput_per_second')
+
+
+def run_compare(args):
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    print(f"before: {before.get('commit')}  after: {after.get('commit')}")
+    regressions = 0
+    for name in sorted(set(before['results']) & set(after['results'])):
+        old, new = before['results'][name], after['results'][name]
+        cells = []
+        for field in COMPARE_FIELDS:
+            if field not in old or field not in new or not old[field]:
+                continue
+            change = (new[field] - old[field]) / old[field] * 100.0
+            # Higher latency or lower throughput is a regression
+            worse = change < -args.threshold if field == 'throughput_per_second' else change > args.threshold
+            regressions += worse
+            cells.append(f"{field}={new[field]:.2f} ({change:+.1f}%{' !' if worse else ''})")
+        print(f"{name:<24} " + '  '.join(cells))
+
+    if regressions:
+        print(f"{regressions} metric(s) regressed by more than {args.threshold:.0f}%")
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the diagnostic services.')
+    subparsers = parser.add_subparsers(required=True)
+
+    load = subparsers.add_parser('load', help='drive the HTTP endpoints at a fixed concurrency')
+    load.add_argument('--targets', nargs='+', default=['brain', 'lung', 'thyroid', 'assess'],
+                      choices=['brain', 'lung', 'thyroid', 'assess'])
+    load.add_argument('--concurrency', type=int, default=8)
+    load.add_argument('--requests', type=int, default=200, help='measured requests per target')
+    load.add_argument('--warmup', type=int, default=20, help='unmeasured requests per target')
+    load.add_argument('--payloads', type=int, default=64, help='distinct JSON payloads per target')
+    load.add_argument('--repeat-images', action='store_true',
+                      help='resend identical images so brain serves them from its prediction cache')
+    load.add_argument('--mode', choices=['async', 'sync'], default='async',
+                      help='sync waits for the (stubbed) LLM text in brain and thyroid')
+    load.add_argument('--timeout', type=float, default=60.0)
+    load.add_argument('--brain-url', default='http://127.0.0.1:5002')
+    load.add_argument('--lung-url', default='http://127.0.0.1:5004')
+    load.add_argument('--thyroid-url', default='http://127.0.0.1:5003')
+    load.add_argument('--spawn', action='store_true', help='start the services with a stub LLM')
+    load.add_argument('--workers', type=int, default=1, help='serve.py workers per spawned service')
+    load.add_argument('--startup-timeout', type=float, default=120.0)
+    load.add_argument('--stub-latency-ms', type=float, default=200.0)
+    load.add_argument('--pid', action='append', default=[], metavar='NAME=PID',
+                      help='report peak RSS of an already running service')
+    load.add_argument('--seed', type=int, default=0)
+    load.add_argument('-o', '--output')
+    load.set_defaults(func=run_load)
+
+    micro = subparsers.add_parser('micro', help='time the in-process hot paths')
+    micro.add_argument('--targets', nargs='+', default=['brain', 'lung', 'assess'], choices=sorted(MICRO_SUITES))
+    micro.add_argument('--iterations', type=int, default=200)
+    micro.add_argument('--warmup', type=int, default=20)
+    micro.add_argument('--batch-size', type=int, default=256)
+    micro.add_argument('--stub-latency-ms', type=float, default=0.0)
+    micro.add_argument('--seed', type=int, default=0)
+    micro.add_argument('-o', '--output')
+    micro.set_defaults(func=run_micro)
+
+    compare = subparsers.add_parser('compare', help='compare two reports')
+    compare.add_argument('before')
+    compare.add_argument('after')
+    compare.add_argument('--threshold', type=float, default=10.0, help='percent change flagged as a regression')
+    compare.set_defaults(func=run_compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,64 @@
-from flask import Flask, request, send_from_directory, jsonify
+from flask import Flask, Response, request, send_file, jsonify, stream_with_context
+from werkzeug.utils import safe_join
 from flask_cors import CORS
-from tensorflow.keras.models import load_model
-from keras.preprocessing.image import load_img, img_to_array
 import numpy as np
 import os
-import google.generativeai as genai
+import json
+from concurrent.futures import ThreadPoolExecutor
+from batching import MicroBatcher
+from brain_model import configure_threads, load_classifier
+from llm_cache import ResponseCache
+from image_io import IMAGE_SIZE, decode_image, is_archive_name, iter_archive_images
+from upload_store import STORED_NAME, UploadStore, PredictionCache, content_hash
+from model_registry import registry
+from jobs import JobManager
+from llm_client import create_client
+from metrics import Metrics
+from audit import create_audit_log
 
 # Initialize Flask app
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
-# Load the trained model
-model = load_model('model/model.h5')
+# Per-stage latency, in-flight requests and cache ratios on /metrics
+metrics = Metrics('brain')
+metrics.instrument(app)
+
+# Prediction audit trail, written off the request path
+audit = create_audit_log('brain')
+
+# model/model.h5 runs on full TensorFlow; a .tflite export from brain_model.py
+# runs on the TFLite interpreter without importing TensorFlow
+MODEL_PATH = os.environ.get('BRAIN_MODEL_PATH', 'model/model.h5')
+if not MODEL_PATH.endswith('.tflite'):
+    # Size TensorFlow's thread pools before it runs anything (TF_INTRA_OP_THREADS / TF_INTER_OP_THREADS)
+    configure_threads()
+
+# Batch concurrent uploads into a single forward pass
+BATCH_MAX_SIZE = int(os.environ.get('BATCH_MAX_SIZE', 16))
+BATCH_MAX_WAIT_MS = float(os.environ.get('BATCH_MAX_WAIT_MS', 5))
+
+# Bulk scoring decodes on a worker pool and runs inference in large batches
+BULK_BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', 64))
+
+# Register the trained model; the shared registry loads it on first use (as a
+# traced graph function or TFLite interpreter), warmed up for every batch size
+# the batchers produce
+WARMUP_BATCH_SIZES = list(range(1, BATCH_MAX_SIZE + 1)) + [BULK_BATCH_SIZE]
+registry.register('brain', MODEL_PATH, lambda path: load_classifier(path, WARMUP_BATCH_SIZES))
+
+# One forward pass over a stacked batch of images
+def predict_batch(batch):
+    with metrics.stage('model_predict'):
+        return registry.get('brain').predict(batch, verbose=0)
+
+batcher = MicroBatcher(predict_batch,
+                       max_batch_size=BATCH_MAX_SIZE,
+                       max_wait_ms=BATCH_MAX_WAIT_MS,
+                       name='brain')
+
+decode_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('DECODE_WORKERS', os.cpu_count() or 4)),
+                                 thread_name_prefix='decode')
 
 # Class labels
 class_labels = ['pituitary', 'glioma', 'notumor', 'meningioma']
@@ -23,50 +70,194 @@ if not os.path.exists(UPLOAD_FOLDER):
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
-# Initialize Gemini API
-GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY', 'your-api-key-here')
-genai.configure(api_key="")
+# Keeping a copy of each upload is optional and happens off the request path
+SAVE_UPLOADS = os.environ.get('SAVE_UPLOADS', '1') == '1'
+upload_writer = ThreadPoolExecutor(max_workers=2, thread_name_prefix='upload-writer')
+
+# Uploads are stored by content hash, so re-uploads are deduplicated on disk.
+# The folder is capped by size and by time since last use (0 disables a cap).
+UPLOAD_MAX_MB = float(os.environ.get('UPLOAD_MAX_MB', 1024))
+UPLOAD_MAX_AGE_DAYS = float(os.environ.get('UPLOAD_MAX_AGE_DAYS', 30))
+upload_store = UploadStore(UPLOAD_FOLDER,
+                           max_bytes=int(UPLOAD_MAX_MB * 2**20) if UPLOAD_MAX_MB > 0 else None,
+                           max_age_seconds=UPLOAD_MAX_AGE_DAYS * 24 * 3600 if UPLOAD_MAX_AGE_DAYS > 0 else None)
 
-# Initialize Gemini model
-gemini_model = genai.GenerativeModel('gemini-1.5-flash')
+# Content-addressed files never change, so browsers may keep them for good
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+THUMBNAIL_SIZES = (64, 128, 256)
+
+# Remember results per image hash so a repeat scan skips decode and inference.
+# Entries are tagged with the model file version so a new model starts fresh.
+prediction_cache = PredictionCache(os.environ.get('PREDICTION_CACHE_PATH', 'prediction_cache.db'),
+                                   max_entries=int(os.environ.get('PREDICTION_CACHE_SIZE', 10000)))
+
+# Shared, rate-limited LLM client (set GEMINI_API_KEY; LLM_BACKEND=stub to run offline)
+llm = create_client('gemini-1.5-flash')
+
+EXPLANATION_FALLBACK = "Information about this condition is not available at the moment."
+
+# By default predictions return immediately and explanations arrive through
+# a background job; ?mode=sync (or RESPONSE_MODE=sync) keeps the combined response
+# Job state goes to a SQLite file so any serve.py worker can answer a poll
+RESPONSE_MODE = os.environ.get('RESPONSE_MODE', 'async')
+jobs = JobManager(max_workers=int(os.environ.get('JOB_WORKERS', 4)), name='brain-jobs',
+                  store_path=os.environ.get('BRAIN_JOB_STORE_PATH', 'brain_jobs.db') or None)
+
+# Cache explanations: there is only one prompt per class label
+EXPLANATION_CACHE_TTL = float(os.environ.get('EXPLANATION_CACHE_TTL', 7 * 24 * 3600))
+EXPLANATION_CACHE_SIZE = int(os.environ.get('EXPLANATION_CACHE_SIZE', 32))
+EXPLANATION_CACHE_PATH = os.environ.get('EXPLANATION_CACHE_PATH', 'explanation_cache.json') or None
+explanation_cache = ResponseCache(max_entries=EXPLANATION_CACHE_SIZE,
+                                  ttl_seconds=EXPLANATION_CACHE_TTL,
+                                  persist_path=EXPLANATION_CACHE_PATH)
+
+# Write an upload copy (runs on upload_writer, off the request path)
+def save_upload(image_bytes, name):
+    with metrics.stage('save_upload'):
+        return upload_store.put(image_bytes, name)
+
+# Map a class label to the result string shown to the user
+def result_for_label(label):
+    if label == 'notumor':
+        return "No Tumor"
+    return f"Tumor: {label.capitalize()}"
+
+# Helper function to build the Gemini prompt for a result
+def build_explanation_prompt(tumor_type):
+    if tumor_type == "No Tumor":
+        return "Provide a brief, simple explanation about what it means when an MRI brain scan shows no tumor. Make it understandable for a general audience in 2-3 sentences."
+
+    # Extract the tumor type from the result string
+    tumor_name = tumor_type.split(": ")[1]
+    return f"Provide a brief, simple explanation about what a {tumor_name} brain tumor is. Include basic information about its characteristics, common symptoms, and general prognosis. Make it understandable for a general audience in 3-4 sentences."
+
+# Call the LLM client; raises on failure (or an open circuit) so errors are never cached
+def generate_explanation(tumor_type):
+    with metrics.stage('llm_explanation'):
+        return llm.generate(build_explanation_prompt(tumor_type))
 
 # Helper function to get explanation from Gemini API
 def get_explanation(tumor_type):
-    if tumor_type == "No Tumor":
-        prompt = "Provide a brief, simple explanation about what it means when an MRI brain scan shows no tumor. Make it understandable for a general audience in 2-3 sentences."
-    else:
-        # Extract the tumor type from the result string
-        tumor_name = tumor_type.split(": ")[1]
-        prompt = f"Provide a brief, simple explanation about what a {tumor_name} brain tumor is. Include basic information about its characteristics, common symptoms, and general prognosis. Make it understandable for a general audience in 3-4 sentences."
-    
     try:
-        response = gemini_model.generate_content(prompt)
-        return response.text
+        return explanation_cache.get_or_create(tumor_type, generate_explanation)
     except Exception as e:
         print(f"Error getting explanation from Gemini: {e}")
-        return "Information about this condition is not available at the moment."
+        return EXPLANATION_FALLBACK
+
+# Helper function to classify raw image bytes (or a file path) without the explanation
+def classify_image(image):
+    if isinstance(image, str):
+        with open(image, 'rb') as f:
+            image = f.read()
+
+    # Decode in memory into this thread's preallocated, normalized buffer
+    with metrics.stage('decode'):
+        img_array = decode_image(image, IMAGE_SIZE)
+
+    # The batcher adds the batch dimension and returns this image's row;
+    # this stage includes the queue wait and the shared forward pass
+    with metrics.stage('batch_inference'):
+        predictions = batcher.submit(img_array)
+    predicted_class_index = int(np.argmax(predictions))
+    confidence_score = float(np.max(predictions))
+
+    return result_for_label(class_labels[predicted_class_index]), confidence_score
 
 # Helper function to predict tumor type
-def predict_tumor(image_path):
-    IMAGE_SIZE = 128
-    img = load_img(image_path, target_size=(IMAGE_SIZE, IMAGE_SIZE))
-    img_array = img_to_array(img) / 255.0  # Normalize pixel values
-    img_array = np.expand_dims(img_array, axis=0)  # Add batch dimension
-
-    predictions = model.predict(img_array)
-    predicted_class_index = np.argmax(predictions, axis=1)[0]
-    confidence_score = np.max(predictions, axis=1)[0]
-
-    if class_labels[predicted_class_index] == 'notumor':
-        result = "No Tumor"
-    else:
-        result = f"Tumor: {class_labels[predicted_class_index].capitalize()}"
-    
+def predict_tumor(image):
+    result, confidence_score = classify_image(image)
+
     # Get explanation from Gemini API
     explanation = get_explanation(result)
     
     return result, confidence_score, explanation
 
+# Classify an upload, reusing the stored result if this exact image was seen before.
+# The explanation is None unless it was cached alongside the result.
+def classify_upload(image_bytes, digest, model_tag):
+    with metrics.stage('prediction_cache_lookup'):
+        cached = prediction_cache.get(digest, model_tag)
+    if cached is not None:
+        return cached
+
+    result, confidence = classify_image(image_bytes)
+    prediction_cache.set(digest, result, confidence, None, model_tag)
+    return result, confidence, None
+
+# Fetch the explanation for a classified upload and remember it with the result
+def explain_upload(digest, result, confidence, model_tag):
+    explanation = get_explanation(result)
+
+    # Don't pin the fallback text to this image; it is refetched next time
+    if explanation != EXPLANATION_FALLBACK:
+        prediction_cache.set(digest, result, confidence, explanation, model_tag)
+    return explanation
+
+# Predict an upload including its explanation (the combined, blocking response)
+def predict_upload(image_bytes, digest):
+    model_tag = registry.version('brain')
+    result, confidence, explanation = classify_upload(image_bytes, digest, model_tag)
+    if explanation is None:
+        explanation = explain_upload(digest, result, confidence, model_tag)
+    return result, confidence, explanation
+
+# Score one chunk of (name, bytes) pairs with a single forward pass
+def score_chunk(chunk):
+    results = [None] * len(chunk)
+    digests = [content_hash(data) for _, data in chunk]
+    model_tag = registry.version('brain')
+
+    # Reuse cached results and only decode the images we haven't seen
+    pending = []
+    for i, digest in enumerate(digests):
+        cached = prediction_cache.get(digest, model_tag)
+        if cached is not None:
+            results[i] = {'result': cached[0], 'confidence': cached[1]}
+        else:
+            pending.append(i)
+
+    if pending:
+        # Workers decode straight into their row of the batch array
+        batch = np.empty((len(pending), IMAGE_SIZE, IMAGE_SIZE, 3), dtype=np.float32)
+        futures = [decode_pool.submit(decode_image, chunk[i][1], IMAGE_SIZE, batch[row])
+                   for row, i in enumerate(pending)]
+
+        decoded = []
+        for row, (i, future) in enumerate(zip(pending, futures)):
+            try:
+                future.result()
+                decoded.append(row)
+            except Exception as e:
+                results[i] = {'error': f'Could not decode image: {e}'}
+
+        if decoded:
+            inputs = batch if len(decoded) == len(pending) else batch[decoded]
+            predictions = predict_batch(inputs)
+            for row, probabilities in zip(decoded, predictions):
+                i = pending[row]
+                result = result_for_label(class_labels[int(np.argmax(probabilities))])
+                confidence = float(np.max(probabilities))
+                prediction_cache.set(digests[i], result, confidence, model_tag=model_tag)
+                results[i] = {'result': result, 'confidence': confidence}
+
+    for (name, _), digest, entry in zip(chunk, digests, results):
+        entry['file'] = name
+        entry['hash'] = digest
+        if 'confidence' in entry:
+            entry['confidence'] = f"{entry['confidence']*100:.2f}%"
+        yield entry
+
+# Group an iterable of (name, bytes) into chunks of BULK_BATCH_SIZE
+def score_images(items):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= BULK_BATCH_SIZE:
+            yield from score_chunk(chunk)
+            chunk = []
+    if chunk:
+        yield from score_chunk(chunk)
+
 # Route for the API endpoint
 @app.route('/', methods=['GET', 'POST'])
 def index():
@@ -75,19 +266,56 @@ def index():
         if 'file' in request.files:
             file = request.files['file']
             if file:
-                # Save the file
-                file_location = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
-                file.save(file_location)
+                # Read the upload straight from the request stream
+                with metrics.stage('read_upload'):
+                    image_bytes = file.read()
+                    digest = content_hash(image_bytes)
+
+                # Save a copy in the background if enabled
+                file_path = thumbnail_path = None
+                if SAVE_UPLOADS:
+                    stored_name = upload_store.name_for(digest, file.filename)
+                    upload_writer.submit(save_upload, image_bytes, stored_name)
+                    file_path = f'/uploads/{stored_name}'
+                    thumbnail_path = f'{file_path}/thumbnail'
+
+                # Compatibility mode: wait for the explanation and return everything at once
+                if request.args.get('mode', RESPONSE_MODE) == 'sync':
+                    result, confidence, explanation = predict_upload(image_bytes, digest)
+                    audit.record(endpoint='predict', file=file.filename, hash=digest, result=result,
+                                 confidence=confidence, model_version=registry.version('brain'),
+                                 timings=metrics.request_timings())
 
-                # Predict the tumor
-                result, confidence, explanation = predict_tumor(file_location)
+                    # Return JSON for React frontend
+                    return jsonify({
+                        'result': result,
+                        'confidence': f"{confidence*100:.2f}%",
+                        'file_path': file_path,
+                        'thumbnail_path': thumbnail_path,
+                        'explanation': explanation
+                    })
+
+                # Return the prediction right away; the explanation follows via the job
+                model_tag = registry.version('brain')
+                result, confidence, explanation = classify_upload(image_bytes, digest, model_tag)
+                audit.record(endpoint='predict', file=file.filename, hash=digest, result=result,
+                             confidence=confidence, model_version=model_tag,
+                             timings=metrics.request_timings())
+                job_id = None
+                if explanation is None:
+                    job_id = jobs.submit({
+                        'explanation': lambda: explain_upload(digest, result, confidence, model_tag)
+                    })
 
-                # Return JSON for React frontend
                 return jsonify({
                     'result': result,
                     'confidence': f"{confidence*100:.2f}%",
-                    'file_path': f'/uploads/{file.filename}',
-                    'explanation': explanation
+                    'file_path': file_path,
+                    'thumbnail_path': thumbnail_path,
+                    'explanation': explanation,
+                    'job_id': job_id,
+                    'job_url': f'/jobs/{job_id}' if job_id else None,
+                    'stream_url': f'/jobs/{job_id}/stream' if job_id else None
                 })
         
         return jsonify({'error': 'No file provided'}), 400
@@ -95,11 +323,120 @@ def index():
     # For GET requests, just return a simple message
     return jsonify({'message': 'Brain Tumor Detection API is running. POST an image to analyze.'})
 
+# Route for bulk scoring: multipart images and/or zip/tar archives, streamed back as NDJSON
+@app.route('/bulk', methods=['POST'])
+def bulk_predict():
+    files = request.files.getlist('files') + request.files.getlist('file')
+    if not files:
+        return jsonify({'error': 'No files provided'}), 400
+
+    def items():
+        for file in files:
+            if is_archive_name(file.filename):
+                yield from iter_archive_images(file.stream)
+            else:
+                yield file.filename, file.read()
+
+    def generate():
+        model_tag = registry.version('brain')
+        for entry in score_images(items()):
+            audit.record(endpoint='bulk', model_version=model_tag, **entry)
+            yield json.dumps(entry) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+# Route to poll a background explanation job
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+    return jsonify(job.snapshot())
+
+# Route to follow a background explanation job as Server-Sent Events
+@app.route('/jobs/<job_id>/stream')
+def stream_job(job_id):
+    if jobs.get(job_id) is None:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+    return Response(stream_with_context(jobs.stream(job_id)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Route to check the service and which models are loaded
+@app.route('/health', methods=['GET'])
+def health_check():
+    return jsonify({'status': 'ok', 'models': registry.stats()})
+
+# Send a stored file with validators; handles If-None-Match/If-Modified-Since (304) and Range
+def send_upload(path, etag, immutable):
+    response = send_file(path, conditional=True, etag=etag,
+                         max_age=IMMUTABLE_MAX_AGE if immutable else 0)
+    if immutable:
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
 # Route to serve uploaded files
 @app.route('/uploads/<filename>')
 def get_uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    path = safe_join(app.config['UPLOAD_FOLDER'], filename)
+    if path is None or not os.path.isfile(path):
+        return jsonify({'error': 'File not found'}), 404
+
+    # Hash-named files are immutable; anything else gets revalidated every time
+    if STORED_NAME.match(filename):
+        upload_store.touch(path)
+        return send_upload(path, etag=os.path.splitext(filename)[0], immutable=True)
+    return send_upload(path, etag=True, immutable=False)
+
+# Route to serve a small JPEG preview of an uploaded file (?size=64, 128 or 256)
+@app.route('/uploads/<filename>/thumbnail')
+def get_upload_thumbnail(filename):
+    size = request.args.get('size', 128, type=int)
+    if size not in THUMBNAIL_SIZES:
+        return jsonify({'error': f'size must be one of {", ".join(map(str, THUMBNAIL_SIZES))}'}), 400
+    if not STORED_NAME.match(filename):
+        return jsonify({'error': 'File not found'}), 404
+
+    try:
+        with metrics.stage('thumbnail'):
+            path = upload_store.thumbnail_for(filename, size)
+    except Exception as e:
+        return jsonify({'error': f'Could not create thumbnail: {e}'}), 415
+    if path is None:
+        return jsonify({'error': 'File not found'}), 404
+
+    upload_store.touch(upload_store.path_for(filename))
+    return send_upload(path, etag=f"{os.path.splitext(filename)[0]}-{size}", immutable=True)
+
+# Route to expose batching metrics for tuning
+@app.route('/batch_metrics')
+def batch_metrics():
+    return jsonify(batcher.stats())
+
+# Route to expose explanation and prediction cache metrics
+@app.route('/cache_metrics')
+def cache_metrics():
+    return jsonify({
+        'explanations': explanation_cache.stats(),
+        'predictions': prediction_cache.stats(),
+        'llm': llm.stats()
+    })
+
+metrics.collect('batcher', batcher.stats)
+metrics.collect('explanation_cache', explanation_cache.stats)
+metrics.collect('prediction_cache', prediction_cache.stats)
+metrics.collect('llm', llm.stats)
+metrics.collect('registry', registry.stats)
+metrics.collect('audit', audit.stats)
+metrics.collect('uploads', upload_store.stats)
+
+# Prefill the explanation cache in the background so first uploads are fast
+explanation_cache.prewarm([result_for_label(label) for label in class_labels], generate_explanation)
 
 if __name__ == '__main__':
+    # Load and warm up the model before taking requests
+    registry.preload('brain')
     # Changed port from 5000 to 5002
     app.run(debug=True, port=5002)
\ No newline at end of file
@@ -0,0 +1,308 @@
+"""
+Compiled inference for the brain tumor classifier.
+
+Keras `model.predict` builds a data adapter and callback list on every call,
+which dominates the cost of predicting a handful of images. BrainClassifier
+instead traces the model once into a tf.function with a fixed
+[None, 128, 128, 3] float32 signature (so no batch size triggers a retrace)
+and warms it up on dummy batches of every batch size the server produces,
+so the first real request doesn't pay for tracing or kernel setup.
+
+The model can also be exported to a TensorFlow Lite flatbuffer, optionally
+float16 or int8 quantized, and served by TFLiteClassifier through
+tflite_runtime without importing full TensorFlow:
+
+    python brain_model.py --quantize int8 --output model/model.tflite
+
+The export is only written if its top-1 predictions agree with the Keras
+model on held-out images (server/uploads, minus anything used for
+calibration) at least --min-agreement of the time. If that leaves fewer
+than --min-holdout images, a deterministic share of the calibration set is
+held out instead, and the export fails if there still aren't enough. The
+held-out file names are printed so the check can be reproduced.
+
+TensorFlow's thread pools are sized from TF_INTRA_OP_THREADS and
+TF_INTER_OP_THREADS (0 = TensorFlow's default of one thread per core); the
+TFLite interpreter uses TF_INTRA_OP_THREADS. Several workers on one machine
+should split the cores between them; serve.py sets these per worker.
+"""
+import argparse
+import glob
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+from image_io import IMAGE_SIZE, decode_image
+from upload_store import content_hash
+
+DEFAULT_KERAS_PATH = 'model/model.h5'
+DEFAULT_TFLITE_PATH = 'model/model.tflite'
+CALIBRATION_DIR = '../testPics'
+HOLDOUT_DIR = 'uploads'
+IMAGE_PATTERNS = ('*.jpg', '*.jpeg', '*.png')
+
+
+def configure_threads(intra_op=None, inter_op=None):
+    """Pin TensorFlow's thread pools. Must run before TensorFlow executes its first op."""
+    import tensorflow as tf
+
+    intra_op = int(os.environ.get('TF_INTRA_OP_THREADS', 0)) if intra_op is None else intra_op
+    inter_op = int(os.environ.get('TF_INTER_OP_THREADS', 0)) if inter_op is None else inter_op
+    try:
+        if intra_op:
+            tf.config.threading.set_intra_op_parallelism_threads(intra_op)
+        if inter_op:
+            tf.config.threading.set_inter_op_parallelism_threads(inter_op)
+    except RuntimeError as e:
+        # The runtime is already initialized; keep whatever it started with
+        print(f"Could not set TensorFlow thread pools: {e}")
+
+
+class BrainClassifier:
+    """A Keras model served through one traced graph function."""
+
+    def __init__(self, model, warmup_batch_sizes=(1,)):
+        import tensorflow as tf
+
+        self.model = model
+        self._tf = tf
+        signature = [tf.TensorSpec(shape=[None, IMAGE_SIZE, IMAGE_SIZE, 3], dtype=tf.float32)]
+        self._forward = tf.function(lambda images: model(images, training=False),
+                                    input_signature=signature)
+        self.warmup(warmup_batch_sizes)
+
+    def warmup(self, batch_sizes):
+        started = time.perf_counter()
+        for size in sorted(set(batch_sizes)):
+            self._forward(self._tf.zeros([size, IMAGE_SIZE, IMAGE_SIZE, 3], dtype=self._tf.float32))
+        if batch_sizes:
+            print(f"Warmed up brain classifier for batch sizes {sorted(set(batch_sizes))} "
+                  f"in {time.perf_counter() - started:.2f}s")
+
+    def predict(self, batch, verbose=0):
+        """Class probabilities for an (N, 128, 128, 3) float32 batch, as a NumPy array."""
+        batch = np.asarray(batch, dtype=np.float32)
+        return self._forward(self._tf.convert_to_tensor(batch)).numpy()
+
+
+def _interpreter_class():
+    # Prefer the standalone runtime; fall back to the copy bundled with TensorFlow
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        from tensorflow.lite import Interpreter
+    return Interpreter
+
+
+def bucket_sizes(batch_sizes):
+    """Powers of two up to the largest batch size, plus the largest size itself."""
+    largest = max(batch_sizes, default=1)
+    sizes = {1 << i for i in range(largest.bit_length()) if 1 << i <= largest}
+    sizes.add(largest)
+    return sorted(sizes)
+
+
+class TFLiteClassifier:
+    """
+    A TensorFlow Lite export with the same predict() interface as
+    BrainClassifier.
+
+    Resizing an interpreter's input re-plans and re-allocates all of its
+    tensors, so instead of resizing per batch there is one interpreter per
+    bucket size (see bucket_sizes), each allocated once. A batch is padded
+    up to the smallest bucket that fits it, and batches larger than the
+    biggest bucket are run in chunks. Interpreters are not thread-safe, so
+    calls on each one are serialized.
+    """
+
+    def __init__(self, path, num_threads=None, warmup_batch_sizes=(1,)):
+        if num_threads is None:
+            num_threads = int(os.environ.get('TF_INTRA_OP_THREADS', 0)) or None
+        self.path = path
+        self.num_threads = num_threads
+        self.buckets = bucket_sizes(warmup_batch_sizes)
+        self._interpreters = {}  # bucket size -> (interpreter, lock)
+        self.lock = threading.Lock()
+
+        interpreter, _ = self._interpreter(self.buckets[0])
+        self.input = interpreter.get_input_details()[0]
+        self.output = interpreter.get_output_details()[0]
+        self.warmup(self.buckets if warmup_batch_sizes else ())
+
+    def _interpreter(self, size):
+        with self.lock:
+            entry = self._interpreters.get(size)
+            if entry is None:
+                interpreter = _interpreter_class()(model_path=self.path, num_threads=self.num_threads)
+                index = interpreter.get_input_details()[0]['index']
+                interpreter.resize_tensor_input(index, [size, IMAGE_SIZE, IMAGE_SIZE, 3])
+                interpreter.allocate_tensors()
+                entry = self._interpreters[size] = (interpreter, threading.Lock())
+            return entry
+
+    def warmup(self, batch_sizes):
+        started = time.perf_counter()
+        for size in sorted(set(batch_sizes)):
+            self.predict(np.zeros((size, IMAGE_SIZE, IMAGE_SIZE, 3), dtype=np.float32))
+        if batch_sizes:
+            print(f"Warmed up TFLite brain classifier for bucket sizes {sorted(set(batch_sizes))} "
+                  f"in {time.perf_counter() - started:.2f}s")
+
+    def _quantize(self, batch):
+        scale, zero_point = self.input['quantization']
+        if self.input['dtype'] == np.float32 or not scale:
+            return batch.astype(self.input['dtype'], copy=False)
+        return np.round(batch / scale + zero_point).astype(self.input['dtype'])
+
+    def _dequantize(self, output):
+        scale, zero_point = self.output['quantization']
+        if self.output['dtype'] == np.float32 or not scale:
+            return output.astype(np.float32, copy=False)
+        return (output.astype(np.float32) - zero_point) * scale
+
+    def _invoke(self, batch):
+        n_rows = batch.shape[0]
+        size = next(size for size in self.buckets if size >= n_rows)
+        if size > n_rows:
+            batch = np.concatenate([batch, np.zeros((size - n_rows,) + batch.shape[1:], dtype=batch.dtype)])
+        interpreter, lock = self._interpreter(size)
+        with lock:
+            interpreter.set_tensor(self.input['index'], self._quantize(batch))
+            interpreter.invoke()
+            return self._dequantize(interpreter.get_tensor(self.output['index']))[:n_rows].copy()
+
+    def predict(self, batch, verbose=0):
+        """Class probabilities for an (N, 128, 128, 3) float32 batch, as a NumPy array."""
+        batch = np.asarray(batch, dtype=np.float32)
+        largest = self.buckets[-1]
+        if batch.shape[0] <= largest:
+            return self._invoke(batch)
+        return np.concatenate([self._invoke(batch[start:start + largest])
+                               for start in range(0, batch.shape[0], largest)])
+
+
+def load_classifier(path, warmup_batch_sizes=(1,)):
+    """Load a .tflite export or a Keras model file, whichever path points at."""
+    if path.endswith('.tflite'):
+        return TFLiteClassifier(path, warmup_batch_sizes=warmup_batch_sizes)
+
+    import tensorflow as tf
+    model = tf.keras.models.load_model(path, compile=False)
+    return BrainClassifier(model, warmup_batch_sizes)
+
+
+def load_images(folder):
+    """Decode every distinct image in folder; returns (paths, content hashes, (N, 128, 128, 3) float32 array)."""
+    paths = sorted(path for pattern in IMAGE_PATTERNS for path in glob.glob(os.path.join(folder, pattern)))
+    loaded, digests, images = [], [], []
+    for path in paths:
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest = content_hash(data)
+        if digest in digests:
+            continue
+        try:
+            images.append(decode_image(data, IMAGE_SIZE).copy())
+        except Exception as e:
+            print(f"Skipping {path}: {e}")
+            continue
+        loaded.append(path)
+        digests.append(digest)
+    array = np.stack(images) if images else np.empty((0, IMAGE_SIZE, IMAGE_SIZE, 3), dtype=np.float32)
+    return loaded, digests, array
+
+
+def split_images(calibration_dir, holdout_dir, min_holdout=5, holdout_fraction=0.3):
+    """
+    Calibration images come from calibration_dir; held-out images from
+    holdout_dir, excluding anything also used for calibration. If that leaves
+    fewer than min_holdout images, the last max(min_holdout, holdout_fraction)
+    of the sorted calibration set is held out instead, as long as at least one
+    calibration image remains. Returns (calibration, holdout, holdout paths).
+    """
+    calibration_paths, calibration_digests, calibration = load_images(calibration_dir)
+    holdout_paths, holdout_digests, holdout = load_images(holdout_dir)
+    seen = set(calibration_digests)
+    keep = [i for i, digest in enumerate(holdout_digests) if digest not in seen]
+    holdout, holdout_paths = holdout[keep], [holdout_paths[i] for i in keep]
+
+    if len(holdout) < min_holdout:
+        n_holdout = max(min_holdout, int(len(calibration) * holdout_fraction))
+        if len(calibration) > n_holdout:
+            print(f"Only {len(holdout)} held-out images in {holdout_dir}; "
+                  f"holding out {n_holdout} of {len(calibration)} calibration images instead")
+            holdout, holdout_paths = calibration[-n_holdout:], calibration_paths[-n_holdout:]
+            calibration = calibration[:-n_holdout]
+    return calibration, holdout, holdout_paths
+
+
+def export_tflite(model, quantize='none', calibration=None):
+    """Convert a Keras model to TFLite bytes, optionally float16 or int8 (calibrated) quantized."""
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantize == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantize == 'int8':
+        if calibration is None or len(calibration) == 0:
+            raise ValueError('int8 quantization needs calibration images')
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        # Input and output stay float32 so the server feeds it like the Keras model
+        converter.representative_dataset = lambda: ([image[np.newaxis]] for image in calibration)
+    return converter.convert()
+
+
+def top1_agreement(reference, candidate, images):
+    """Fraction of images where both classifiers predict the same class."""
+    if len(images) == 0:
+        return 0.0
+    expected = np.argmax(reference.predict(images), axis=1)
+    actual = np.argmax(candidate.predict(images), axis=1)
+    return float(np.mean(expected == actual))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the brain classifier to TensorFlow Lite.')
+    parser.add_argument('--model', default=DEFAULT_KERAS_PATH)
+    parser.add_argument('--output', default=DEFAULT_TFLITE_PATH)
+    parser.add_argument('--quantize', choices=['none', 'float16', 'int8'], default='float16')
+    parser.add_argument('--calibration-dir', default=CALIBRATION_DIR)
+    parser.add_argument('--holdout-dir', default=HOLDOUT_DIR)
+    parser.add_argument('--min-agreement', type=float, default=0.95,
+                        help='minimum top-1 agreement with the Keras model on held-out images')
+    parser.add_argument('--min-holdout', type=int, default=5,
+                        help='minimum number of held-out images to check agreement on')
+    args = parser.parse_args()
+
+    calibration, holdout, holdout_paths = split_images(args.calibration_dir, args.holdout_dir,
+                                                       min_holdout=args.min_holdout)
+    print(f"{len(calibration)} calibration images, {len(holdout)} held-out images")
+    for path in holdout_paths:
+        print(f"  held out: {path}")
+    if len(holdout) < args.min_holdout:
+        print(f"Fewer than {args.min_holdout} held-out images to check agreement on; not saving")
+        sys.exit(1)
+
+    reference = load_classifier(args.model, warmup_batch_sizes=())
+    flatbuffer = export_tflite(reference.model, args.quantize, calibration)
+
+    tmp_path = f"{args.output}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(flatbuffer)
+    candidate = TFLiteClassifier(tmp_path, warmup_batch_sizes=())
+
+    agreement = top1_agreement(reference, candidate, holdout)
+    print(f"Top-1 agreement on held-out images: {agreement*100:.2f}% "
+          f"({len(flatbuffer) / 2**20:.1f} MB, {args.quantize})")
+
+    if agreement < args.min_agreement:
+        os.remove(tmp_path)
+        print(f"Agreement below {args.min_agreement*100:.0f}%; not saving {args.output}")
+        sys.exit(1)
+
+    os.replace(tmp_path, args.output)
+    print(f"Saved TFLite model to {args.output}")
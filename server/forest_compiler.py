@@ -0,0 +1,187 @@
+"""
+Compile a fitted scikit-learn RandomForestClassifier into flat NumPy arrays
+and evaluate it with vectorized traversal over a batch of rows.
+
+sklearn's predict/predict_proba spend most of a single-row call on input
+validation and per-tree dispatch. Here all trees live in one set of arrays
+(feature, threshold, children, leaf values) and every (row, tree) pair is
+advanced one level per step, so a whole batch takes max_depth NumPy ops.
+Large batches are walked CHUNK_ROWS rows at a time to keep the per-step
+temporaries small.
+
+Check parity with sklearn and benchmark with:
+    python forest_compiler.py [model.pkl]
+"""
+import pickle
+import sys
+import time
+import warnings
+
+import numpy as np
+
+# Rows evaluated per traversal; bounds the (rows, trees[, classes]) temporaries
+CHUNK_ROWS = 4096
+
+
+class CompiledForest:
+    def __init__(self, feature, threshold, left, right, missing_left, values, roots, max_depth, classes,
+                 feature_names=None):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.missing_left = missing_left
+        self.values = values
+        self.roots = roots
+        self.max_depth = max_depth
+        self.classes_ = classes
+        self.feature_names = feature_names
+
+    @classmethod
+    def from_sklearn(cls, forest):
+        """Flatten every tree of a fitted RandomForestClassifier into shared arrays."""
+        features, thresholds, lefts, rights, missing, values, roots = [], [], [], [], [], [], []
+        offset = 0
+        max_depth = 0
+
+        for estimator in forest.estimators_:
+            tree = estimator.tree_
+            n_nodes = tree.node_count
+            node_ids = np.arange(n_nodes, dtype=np.int64)
+            is_leaf = tree.children_left == -1
+
+            # Leaves point at themselves, so extra traversal steps are no-ops
+            left = np.where(is_leaf, node_ids, tree.children_left) + offset
+            right = np.where(is_leaf, node_ids, tree.children_right) + offset
+
+            # Per-tree class probabilities (older sklearn stores counts)
+            value = tree.value[:, 0, :].astype(np.float64)
+            totals = value.sum(axis=1, keepdims=True)
+            value = value / np.where(totals == 0, 1.0, totals)
+
+            missing_go_to_left = getattr(tree, 'missing_go_to_left', None)
+            if missing_go_to_left is None:
+                missing_go_to_left = np.zeros(n_nodes, dtype=bool)
+
+            features.append(np.where(is_leaf, 0, tree.feature))
+            thresholds.append(np.where(is_leaf, np.inf, tree.threshold))
+            lefts.append(left)
+            rights.append(right)
+            missing.append(np.asarray(missing_go_to_left, dtype=bool))
+            values.append(value)
+            roots.append(offset)
+
+            offset += n_nodes
+            max_depth = max(max_depth, tree.max_depth)
+
+        return cls(
+            feature=np.concatenate(features).astype(np.intp),
+            threshold=np.concatenate(thresholds).astype(np.float64),
+            left=np.concatenate(lefts).astype(np.intp),
+            right=np.concatenate(rights).astype(np.intp),
+            missing_left=np.concatenate(missing),
+            values=np.concatenate(values),
+            roots=np.asarray(roots, dtype=np.intp),
+            max_depth=max_depth,
+            classes=np.asarray(forest.classes_),
+            feature_names=list(getattr(forest, 'feature_names_in_', [])) or None,
+        )
+
+    def leaves(self, X):
+        """Return the (n_rows, n_trees) leaf index reached by each row in each tree."""
+        # sklearn compares float32 inputs against float64 thresholds
+        X = np.asarray(X, dtype=np.float32)
+        n_rows = X.shape[0]
+        rows = np.arange(n_rows)[:, None]
+        nodes = np.broadcast_to(self.roots, (n_rows, len(self.roots))).copy()
+
+        for _ in range(self.max_depth):
+            x = X[rows, self.feature[nodes]]
+            go_left = (x <= self.threshold[nodes]) | (np.isnan(x) & self.missing_left[nodes])
+            nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+
+        return nodes
+
+    def predict_proba(self, X):
+        """Class probabilities, evaluated CHUNK_ROWS rows at a time."""
+        X = np.asarray(X, dtype=np.float32)
+        if len(X) <= CHUNK_ROWS:
+            return self.values[self.leaves(X)].mean(axis=1)
+        proba = np.empty((len(X), self.values.shape[-1]), dtype=self.values.dtype)
+        for start in range(0, len(X), CHUNK_ROWS):
+            stop = start + CHUNK_ROWS
+            proba[start:stop] = self.values[self.leaves(X[start:stop])].mean(axis=1)
+        return proba
+
+    def predict(self, X):
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+
+def compile_forest(model):
+    """Compile model if it is a plain random forest classifier, else return None."""
+    if hasattr(model, 'estimators_') and all(hasattr(e, 'tree_') for e in model.estimators_) \
+            and hasattr(model, 'classes_'):
+        return CompiledForest.from_sklearn(model)
+    return None
+
+
+def check_parity(model, compiled, X):
+    """Return (label agreement, max |dproba|) between sklearn and the compiled forest."""
+    expected = model.predict_proba(X)
+    actual = compiled.predict_proba(X)
+    agreement = float(np.mean(model.predict(X) == compiled.predict(X)))
+    return agreement, float(np.abs(expected - actual).max())
+
+
+def benchmark(fn, X, repeat):
+    fn(X)  # warm up
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn(X)
+    return (time.perf_counter() - started) / repeat * 1000.0
+
+
+def report(name, model, X):
+    compiled = compile_forest(model)
+    if compiled is None:
+        print(f"{name}: not a plain RandomForestClassifier, skipping")
+        return True
+
+    agreement, max_diff = check_parity(model, compiled, X)
+    print(f"{name}: label agreement {agreement*100:.2f}%, max |dproba| {max_diff:.2e}")
+
+    single = X[:1]
+    batch = X[:1000]
+    print(f"  single row: sklearn {benchmark(model.predict_proba, single, 200):.3f} ms, "
+          f"compiled {benchmark(compiled.predict_proba, single, 200):.3f} ms")
+    print(f"  {len(batch)} rows:  sklearn {benchmark(model.predict_proba, batch, 20):.3f} ms, "
+          f"compiled {benchmark(compiled.predict_proba, batch, 20):.3f} ms")
+    return agreement == 1.0 and max_diff < 1e-9
+
+
+if __name__ == '__main__':
+    from thyroid_assessment import SYMPTOMS, get_assessment_model
+
+    # Benchmarks pass plain arrays to models fitted on DataFrames
+    warnings.filterwarnings('ignore', message='X does not have valid feature names')
+
+    rng = np.random.RandomState(0)
+    ok = True
+
+    assessment = get_assessment_model().model
+    ok &= report('assessment model', assessment, rng.rand(5000, len(SYMPTOMS)))
+
+    model_path = sys.argv[1] if len(sys.argv) > 1 else 'model.pkl'
+    try:
+        with open(model_path, 'rb') as f:
+            model = pickle.load(f)
+    except FileNotFoundError:
+        print(f"{model_path} not found, skipping")
+    else:
+        n_features = model.n_features_in_
+        X = rng.rand(5000, n_features) * 100
+        # Include missing values, as empty form fields become NaN
+        X[rng.rand(*X.shape) < 0.05] = np.nan
+        ok &= report(model_path, model, X)
+
+    sys.exit(0 if ok else 1)
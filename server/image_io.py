@@ -0,0 +1,96 @@
+import io
+import os
+import tarfile
+import threading
+import zipfile
+
+import numpy as np
+from PIL import Image
+
+IMAGE_SIZE = 128
+
+# Only bother with reduced-scale decoding when the source is this many times
+# larger than the target on both sides
+DRAFT_MIN_RATIO = 2
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.gif', '.webp', '.tif', '.tiff'}
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+# Skip archive members bigger than this rather than reading them into memory
+MAX_MEMBER_BYTES = 50 * 1024 * 1024
+
+_local = threading.local()
+
+
+def get_buffer(size=IMAGE_SIZE):
+    """Return this thread's preallocated (size, size, 3) float32 buffer."""
+    buffer = getattr(_local, 'buffer', None)
+    if buffer is None or buffer.shape[0] != size:
+        buffer = np.empty((size, size, 3), dtype=np.float32)
+        _local.buffer = buffer
+    return buffer
+
+
+def decode_image(data, size=IMAGE_SIZE, out=None):
+    """
+    Decode raw image bytes straight from memory into a normalized
+    (size, size, 3) float32 array, matching load_img + img_to_array / 255.
+
+    Large JPEGs are decoded at reduced scale (draft mode) so a multi-megapixel
+    scan never gets fully decompressed just to be shrunk to 128x128.
+    The result is written into out, or into this thread's reusable buffer,
+    so callers must copy it if they keep it past the next decode.
+    """
+    img = Image.open(io.BytesIO(data))
+
+    if img.format == 'JPEG' and img.width >= size * DRAFT_MIN_RATIO and img.height >= size * DRAFT_MIN_RATIO:
+        # Let libjpeg scale down by 1/2, 1/4 or 1/8 while staying >= size
+        img.draft('RGB', (size, size))
+
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    if img.size != (size, size):
+        # load_img defaults to nearest-neighbour interpolation
+        img = img.resize((size, size), Image.NEAREST)
+
+    if out is None:
+        out = get_buffer(size)
+    np.divide(np.asarray(img, dtype=np.uint8), 255.0, out=out, casting='unsafe')
+    return out
+
+
+
+def is_image_name(filename):
+    return os.path.splitext(filename or '')[1].lower() in IMAGE_EXTENSIONS
+
+
+def is_archive_name(filename):
+    return (filename or '').lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def iter_archive_images(fileobj):
+    """
+    Yield (name, bytes) for every image in a zip or tar archive, one member
+    at a time so memory stays bounded by the largest single image.
+    """
+    if zipfile.is_zipfile(fileobj):
+        fileobj.seek(0)
+        with zipfile.ZipFile(fileobj) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or not is_image_name(info.filename):
+                    continue
+                if info.file_size > MAX_MEMBER_BYTES:
+                    print(f"Skipping oversized archive member {info.filename}")
+                    continue
+                yield info.filename, archive.read(info)
+        return
+
+    fileobj.seek(0)
+    with tarfile.open(fileobj=fileobj, mode='r|*') as archive:
+        for member in archive:
+            if not member.isfile() or not is_image_name(member.name):
+                continue
+            if member.size > MAX_MEMBER_BYTES:
+                print(f"Skipping oversized archive member {member.name}")
+                continue
+            yield member.name, archive.extractfile(member).read()
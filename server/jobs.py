@@ -0,0 +1,226 @@
+"""
+Background jobs for slow follow-up work (LLM explanations, diet advice).
+
+A job is a set of named parts, each computed by a callable on a shared
+thread pool. Clients poll a job's state or follow it as a Server-Sent Events
+stream that emits one event per part as soon as it is ready.
+
+The parts run in the process that created the job, but with a store_path
+every part's state is also written to a SQLite file, so any pre-forked
+worker behind the same socket can answer a poll or stream for it. A worker
+streaming someone else's job re-reads the store every STORE_POLL_SECONDS.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Seconds between SSE keep-alive comments while waiting for a part
+KEEPALIVE_SECONDS = 15
+# How often a stream for a job owned by another worker re-reads the store
+STORE_POLL_SECONDS = 0.25
+# Minimum seconds between deletions of expired jobs from the store
+STORE_PURGE_INTERVAL = 60.0
+
+
+class Job:
+    def __init__(self, job_id, part_names, created=None, local=True):
+        self.id = job_id
+        self.created = time.time() if created is None else created
+        self.parts = OrderedDict((name, {'status': 'pending', 'value': None}) for name in part_names)
+        self.changed = threading.Condition()
+        # False for a read-only copy of a job running in another worker
+        self.local = local
+
+    @property
+    def done(self):
+        return all(part['status'] in ('done', 'error') for part in self.parts.values())
+
+    def snapshot(self):
+        with self.changed:
+            return {
+                'id': self.id,
+                'status': 'done' if self.done else 'pending',
+                'results': {name: part['value'] for name, part in self.parts.items()},
+                'parts': {name: part['status'] for name, part in self.parts.items()},
+            }
+
+    def finish_part(self, name, value, status='done'):
+        with self.changed:
+            self.parts[name] = {'status': status, 'value': value}
+            self.changed.notify_all()
+
+    def ready_parts(self, sent):
+        """Finished parts not in sent, as (name, part) pairs. Caller holds changed."""
+        return [(name, dict(part)) for name, part in self.parts.items()
+                if name not in sent and part['status'] != 'pending']
+
+
+class JobStore:
+    """Job part states in a SQLite file shared by every worker process."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = self._connect()
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS job_parts ('
+            ' job_id TEXT NOT NULL,'
+            ' position INTEGER NOT NULL,'
+            ' name TEXT NOT NULL,'
+            ' status TEXT NOT NULL,'
+            ' value TEXT,'
+            ' created REAL NOT NULL,'
+            ' PRIMARY KEY (job_id, name))'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS job_parts_created ON job_parts (created)')
+        self._conn.commit()
+        self._purged = time.monotonic()
+
+        # SQLite connections must not be shared across fork
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5.0)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _after_fork(self):
+        # Keep the parent's handle referenced so it isn't closed from the child
+        self._parent_conn = self._conn
+        self._lock = threading.Lock()
+        self._conn = self._connect()
+
+    def add(self, job, ttl):
+        with self._lock:
+            if time.monotonic() - self._purged >= STORE_PURGE_INTERVAL:
+                self._conn.execute('DELETE FROM job_parts WHERE created < ?', (time.time() - ttl,))
+                self._purged = time.monotonic()
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO job_parts VALUES (?, ?, ?, ?, NULL, ?)',
+                [(job.id, position, name, 'pending', job.created) for position, name in enumerate(job.parts)])
+            self._conn.commit()
+
+    def finish_part(self, job_id, name, value, status):
+        with self._lock:
+            self._conn.execute(
+                'UPDATE job_parts SET status = ?, value = ? WHERE job_id = ? AND name = ?',
+                (status, json.dumps(value, default=str), job_id, name))
+            self._conn.commit()
+
+    def load(self, job_id, ttl):
+        """A read-only Job with the stored part states, or None if unknown or expired."""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT name, status, value, created FROM job_parts WHERE job_id = ? ORDER BY position',
+                (job_id,)).fetchall()
+        if not rows or rows[0][3] < time.time() - ttl:
+            return None
+        job = Job(job_id, [row[0] for row in rows], created=rows[0][3], local=False)
+        for name, status, value, _ in rows:
+            job.parts[name] = {'status': status, 'value': json.loads(value) if value is not None else None}
+        return job
+
+
+class JobManager:
+    def __init__(self, max_workers=4, ttl_seconds=600, max_jobs=10000, name='jobs', store_path=None):
+        self.max_workers = max_workers
+        self.ttl = ttl_seconds
+        self.max_jobs = max_jobs
+        self.name = name
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._store = JobStore(store_path) if store_path else None
+
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name)
+
+    def submit(self, parts):
+        """
+        Start a job from a dict of part name -> zero-argument callable.
+        A part that raises is marked as an error with the message as its value.
+        """
+        job = Job(uuid.uuid4().hex, list(parts))
+        with self._lock:
+            self._purge()
+            self._jobs[job.id] = job
+        if self._store is not None:
+            self._store.add(job, self.ttl)
+
+        for name, fn in parts.items():
+            self._executor.submit(self._run_part, job, name, fn)
+        return job.id
+
+    def _run_part(self, job, name, fn):
+        try:
+            value, status = fn(), 'done'
+        except Exception as e:
+            print(f"Error in job {job.id} part {name}: {e}")
+            value, status = str(e), 'error'
+        if self._store is not None:
+            try:
+                self._store.finish_part(job.id, name, value, status)
+            except Exception as e:
+                print(f"Error storing job {job.id} part {name}: {e}")
+        job.finish_part(name, value, status=status)
+
+    def _purge(self):
+        cutoff = time.time() - self.ttl
+        while self._jobs:
+            oldest = next(iter(self._jobs.values()))
+            if oldest.created >= cutoff and len(self._jobs) < self.max_jobs:
+                break
+            self._jobs.popitem(last=False)
+
+    def get(self, job_id):
+        """The job if this worker runs it, else a snapshot from the shared store, else None."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and self._store is not None:
+            job = self._store.load(job_id, self.ttl)
+        return job
+
+    def stream(self, job_id):
+        """Yield SSE messages: one event per part as it completes, then 'done'."""
+        job = self.get(job_id)
+        if job is None:
+            yield f"event: error\ndata: {json.dumps({'error': 'Unknown job'})}\n\n"
+            return
+
+        sent = set()
+        while True:
+            if job.local:
+                with job.changed:
+                    ready = job.ready_parts(sent)
+                    if not ready and not job.done:
+                        job.changed.wait(timeout=KEEPALIVE_SECONDS)
+                        ready = job.ready_parts(sent)
+            else:
+                ready = job.ready_parts(sent)
+                keepalive_at = time.monotonic() + KEEPALIVE_SECONDS
+                while not ready and not job.done and time.monotonic() < keepalive_at:
+                    time.sleep(STORE_POLL_SECONDS)
+                    job = self._store.load(job_id, self.ttl) or job
+                    ready = job.ready_parts(sent)
+
+            if not ready and not job.done:
+                yield ": keepalive\n\n"
+                continue
+
+            for name, part in ready:
+                sent.add(name)
+                yield f"event: {name}\ndata: {json.dumps({'status': part['status'], 'value': part['value']})}\n\n"
+
+            if len(sent) == len(job.parts):
+                yield f"event: done\ndata: {json.dumps({'id': job.id})}\n\n"
+                return
@@ -0,0 +1,160 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class ResponseCache:
+    """
+    Keyed cache for LLM responses with a TTL and least-recently-used eviction.
+
+    If persist_path is given, entries are written to a JSON file so they
+    survive restarts. A hit never touches the network, and get_or_create
+    makes concurrent misses for the same key share a single upstream call.
+    """
+
+    def __init__(self, max_entries=128, ttl_seconds=24 * 3600, persist_path=None):
+        self.max_entries = max(1, int(max_entries))
+        self.ttl = float(ttl_seconds)
+        self.persist_path = persist_path
+
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._inflight = {}  # key -> Future for single-flight generation
+        self.hits = 0
+        self.misses = 0
+
+        if persist_path:
+            self._load()
+
+        # A generation in flight in the parent never completes in a forked child
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._inflight = {}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        self._save()
+
+    def get_or_create(self, key, generate):
+        """
+        Return the cached value for key, calling generate(key) on a miss.
+        Concurrent misses for the same key wait for the first caller's result
+        instead of each calling generate. Exceptions propagate to all waiters
+        and nothing is cached.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+
+        if not owner:
+            return future.result()
+
+        try:
+            value = generate(key)
+        except Exception as e:
+            with self._lock:
+                self._inflight.pop(key, None)
+            future.set_exception(e)
+            raise
+
+        self.set(key, value)
+        with self._lock:
+            self._inflight.pop(key, None)
+        future.set_result(value)
+        return value
+
+    def prewarm(self, keys, generate):
+        """
+        Fill the cache for the given keys in a background thread.
+        generate(key) should raise on failure so fallback text is never cached.
+        """
+        def worker():
+            for key in keys:
+                try:
+                    self.get_or_create(key, generate)
+                except Exception as e:
+                    print(f"Error prewarming cache for {key!r}: {e}")
+
+        thread = threading.Thread(target=worker, name='cache-prewarm', daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
+
+    def _load(self):
+        if not os.path.exists(self.persist_path):
+            return
+        try:
+            with open(self.persist_path, 'r') as f:
+                stored = json.load(f)
+        except Exception as e:
+            print(f"Error loading response cache from {self.persist_path}: {e}")
+            return
+
+        now = time.time()
+        for key, expires_at, value in stored:
+            if expires_at > now:
+                self._entries[key] = (expires_at, value)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _save(self):
+        if not self.persist_path:
+            return
+        with self._lock:
+            stored = [[key, expires_at, value] for key, (expires_at, value) in self._entries.items()]
+        with self._save_lock:
+            try:
+                # Write to a temp file first so a crash never leaves a half-written cache;
+                # the name is per process and thread so pre-forked workers don't share it
+                tmp_path = f"{self.persist_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, 'w') as f:
+                    json.dump(stored, f)
+                os.replace(tmp_path, self.persist_path)
+            except Exception as e:
+                print(f"Error saving response cache to {self.persist_path}: {e}")
@@ -0,0 +1,300 @@
+"""
+Shared client for the LLM calls made by brain.py and thyroid.py.
+
+Every call goes through one place that provides:
+  - a bounded worker pool around one long-lived backend client, which caps
+    concurrent upstream requests
+  - a token-bucket rate limiter
+  - a deadline per call covering queueing, retries and the request itself
+  - retries with full jitter, for transient errors only
+  - a circuit breaker that fails fast while the upstream is unhealthy
+
+Local rate limiting and non-transient errors (a blocked or malformed
+response, a 4xx other than 408/429) are counted in stats() but neither
+retried nor fed to the circuit breaker, since they say nothing about the
+upstream's health.
+
+Failures raise; callers already fall back to their canned text or diet JSON.
+
+LLM_BACKEND=stub swaps Gemini for a local stub with configurable latency and
+failure rate, so the whole stack can be load-tested offline.
+"""
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+
+class LLMError(Exception):
+    pass
+
+
+class CircuitOpenError(LLMError):
+    pass
+
+
+class RateLimitedError(LLMError):
+    pass
+
+
+class DeadlineExceededError(LLMError):
+    pass
+
+
+# Raised for a blocked or malformed response (e.g. response.text on a
+# safety-blocked Gemini reply); retrying returns the same thing
+NON_RETRYABLE_ERRORS = (ValueError, TypeError, KeyError, AttributeError)
+
+
+def is_transient(error):
+    """Whether retrying the call that raised error could succeed."""
+    if isinstance(error, NON_RETRYABLE_ERRORS):
+        return False
+    # google.api_core errors carry the HTTP status as .code
+    code = getattr(error, 'code', None)
+    if isinstance(code, int) and 400 <= code < 500 and code not in (408, 429):
+        return False
+    return True
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, deadline):
+        """Take one token, waiting until deadline (monotonic time). Returns False on timeout."""
+        if self.rate <= 0:
+            return True
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """Opens after failure_threshold consecutive failures; lets one trial call through after reset_timeout."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        with self.lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self.trial_in_progress:
+                self.trial_in_progress = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_progress = False
+
+    def release(self):
+        """End a call that says nothing about upstream health, without counting it either way."""
+        with self.lock:
+            self.trial_in_progress = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_progress = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class GeminiBackend:
+    def __init__(self, model_name, generation_config=None, safety_settings=None):
+        import google.generativeai as genai
+
+        api_key = os.environ.get('GEMINI_API_KEY') or os.environ.get('GOOGLE_API_KEY') or ""
+        genai.configure(api_key=api_key)
+        # One client for the lifetime of the process so connections are reused
+        self.model = genai.GenerativeModel(model_name=model_name,
+                                           generation_config=generation_config,
+                                           safety_settings=safety_settings)
+
+    def generate(self, prompt, timeout):
+        response = self.model.generate_content(prompt, request_options={'timeout': timeout})
+        return response.text
+
+
+STUB_DIET = {
+    "include": [{"name": f"Stub food {i}", "reason": "Stub reason"} for i in range(1, 6)],
+    "avoid": [{"name": f"Stub food {i}", "reason": "Stub reason"} for i in range(6, 11)],
+}
+
+
+class StubBackend:
+    """Offline backend: sleeps for a jittered latency and returns canned text."""
+
+    def __init__(self, latency_ms=200.0, jitter_ms=50.0, failure_rate=0.0):
+        self.latency = latency_ms / 1000.0
+        self.jitter = jitter_ms / 1000.0
+        self.failure_rate = failure_rate
+
+    def generate(self, prompt, timeout):
+        time.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        if random.random() < self.failure_rate:
+            raise LLMError('Stub backend failure')
+        if 'JSON' in prompt:
+            return json.dumps(STUB_DIET)
+        if 'HTML' in prompt:
+            return "<p>This is a stub explanation generated offline.</p>"
+        return "This is a stub explanation generated offline."
+
+
+class LLMClient:
+    def __init__(self, backend, max_concurrency=8, rate_per_second=10.0, burst=20, timeout=15.0,
+                 retries=2, backoff=0.5, breaker=None):
+        self.backend = backend
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.bucket = TokenBucket(rate_per_second, burst)
+        self.breaker = breaker or CircuitBreaker()
+
+        self._stats_lock = threading.Lock()
+        self.stats_counts = {'calls': 0, 'successes': 0, 'failures': 0, 'timeouts': 0,
+                             'retries': 0, 'rate_limited': 0, 'short_circuited': 0, 'non_retryable': 0}
+        self._start_pool()
+
+        os.register_at_fork(after_in_child=self._start_pool)
+
+    def _start_pool(self):
+        # The pool size is the cap on concurrent upstream requests; a slot
+        # stays taken until the backend returns, even if the caller gave up
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        self._pool = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='llm')
+        self._stats_lock = threading.Lock()
+        self.bucket.lock = threading.Lock()
+        self.breaker.lock = threading.Lock()
+
+    def _count(self, name):
+        with self._stats_lock:
+            self.stats_counts[name] += 1
+
+    def generate(self, prompt, timeout=None):
+        """Return the generated text, or raise an LLMError subclass."""
+        self._count('calls')
+        deadline = time.monotonic() + (timeout or self.timeout)
+
+        if not self.breaker.allow():
+            self._count('short_circuited')
+            raise CircuitOpenError('LLM circuit breaker is open')
+
+        last_error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self._count('retries')
+                # Full jitter: sleep a random amount up to the exponential backoff
+                delay = random.uniform(0, self.backoff * (2 ** (attempt - 1)))
+                if time.monotonic() + delay >= deadline:
+                    break
+                time.sleep(delay)
+
+            try:
+                text = self._call(prompt, deadline)
+            except RateLimitedError:
+                # Our own token bucket, not the upstream; keep it out of the breaker
+                self._count('rate_limited')
+                self.breaker.release()
+                raise
+            except DeadlineExceededError as e:
+                self._count('timeouts')
+                last_error = e
+                break
+            except Exception as e:
+                if not is_transient(e):
+                    self._count('non_retryable')
+                    self._count('failures')
+                    self.breaker.release()
+                    raise
+                last_error = e
+                continue
+
+            self.breaker.record_success()
+            self._count('successes')
+            return text
+
+        self.breaker.record_failure()
+        self._count('failures')
+        raise last_error or DeadlineExceededError('LLM deadline exceeded')
+
+    def _call(self, prompt, deadline):
+        if not self.bucket.acquire(deadline):
+            raise RateLimitedError('LLM rate limit reached before deadline')
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not self._slots.acquire(timeout=remaining):
+            raise DeadlineExceededError('No LLM connection available before deadline')
+
+        try:
+            future = self._pool.submit(self.backend.generate, prompt, max(deadline - time.monotonic(), 0.1))
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+
+        try:
+            return future.result(timeout=max(deadline - time.monotonic(), 0))
+        except FutureTimeoutError:
+            raise DeadlineExceededError('LLM call exceeded its deadline')
+
+    def stats(self):
+        with self._stats_lock:
+            counts = dict(self.stats_counts)
+        counts['circuit_state'] = self.breaker.state
+        return counts
+
+
+def create_client(model_name='gemini-1.5-flash', generation_config=None, safety_settings=None):
+    """Build an LLMClient from the LLM_* environment variables."""
+    if os.environ.get('LLM_BACKEND', 'gemini') == 'stub':
+        backend = StubBackend(latency_ms=float(os.environ.get('LLM_STUB_LATENCY_MS', 200)),
+                              jitter_ms=float(os.environ.get('LLM_STUB_JITTER_MS', 50)),
+                              failure_rate=float(os.environ.get('LLM_STUB_FAILURE_RATE', 0)))
+    else:
+        backend = GeminiBackend(model_name, generation_config, safety_settings)
+
+    return LLMClient(
+        backend,
+        max_concurrency=int(os.environ.get('LLM_MAX_CONCURRENCY', 8)),
+        rate_per_second=float(os.environ.get('LLM_RATE_PER_SECOND', 10)),
+        burst=int(os.environ.get('LLM_BURST', 20)),
+        timeout=float(os.environ.get('LLM_TIMEOUT', 15)),
+        retries=int(os.environ.get('LLM_RETRIES', 2)),
+        breaker=CircuitBreaker(failure_threshold=int(os.environ.get('LLM_BREAKER_FAILURES', 5)),
+                               reset_timeout=float(os.environ.get('LLM_BREAKER_RESET', 30))),
+    )
@@ -1,179 +1,112 @@
 from flask import Flask, request, jsonify
 import torch
-import torch.nn as nn
-import torch.nn.functional as F
 import numpy as np
 from flask_cors import CORS
-import pandas as pd
-from scipy import stats
 import os
+from lung_features import BINARY_FIELDS, FeatureEncoder, encode_binary
+from lung_model import PARITY_ATOL, PARITY_ATOL_INT8, ANNnet, build_inference_model, check_parity, load_engine
+from model_registry import registry
+from metrics import Metrics
+from audit import batch_digest, create_audit_log
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
-# Define the neural network architecture used during training
-class ANNnet(nn.Module):
-    def __init__(self, input_features=15):  # Adjust input features based on your model
-        super().__init__()
-
-        self.input = nn.Linear(input_features, 256)
-
-        self.fc1 = nn.Linear(256, 256)
-        self.bn1 = nn.BatchNorm1d(256)
-
-        self.fc2 = nn.Linear(256, 256)
-        self.bn2 = nn.BatchNorm1d(256)
-
-        self.fc3 = nn.Linear(256, 256)
-        self.bn3 = nn.BatchNorm1d(256)
-
-        self.fc4 = nn.Linear(256, 256)
-        self.bn4 = nn.BatchNorm1d(256)
-
-        self.fc5 = nn.Linear(256, 256)
-        self.bn5 = nn.BatchNorm1d(256)
-
-        self.output = nn.Linear(256, 1)
-
-    def forward(self, x):
-        x = F.relu(self.input(x))
-        x = F.dropout(x, .5)
-
-        x = self.fc1(x)
-        x = self.bn1(x)
-        x = F.relu(x)
-        x = F.dropout(x, .5)
-
-        x = self.fc2(x)
-        x = self.bn2(x)
-        x = F.relu(x)
-        x = F.dropout(x, .5)
-
-        x = self.fc3(x)
-        x = self.bn3(x)
-        x = F.relu(x)
-        x = F.dropout(x, .5)
-
-        x = self.fc4(x)
-        x = self.bn4(x)
-        x = F.relu(x)
-        x = F.dropout(x, .5)
-
-        x = self.fc5(x)
-        x = self.bn5(x)
-        x = F.relu(x)
-        x = F.dropout(x, .5)
-
-        return self.output(x)
-
-# Helper functions from your training code
-def groupAge(AGE):
-    if AGE < 10:
-        return 0
-    elif AGE < 20:
-        return 1
-    elif AGE < 30:
-        return 2
-    elif AGE < 40:
-        return 3
-    elif AGE < 50:
-        return 4
-    elif AGE < 60:
-        return 5
-    elif AGE < 70:
-        return 6
-    elif AGE < 80:
-        return 7
-    else:
-        return 8
+# Per-stage latency and in-flight requests on /metrics
+metrics = Metrics('lung')
+metrics.instrument(app)
+metrics.collect('registry', registry.stats)
+
+# Prediction audit trail, written off the request path
+audit = create_audit_log('lung')
+metrics.collect('audit', audit.stats)
+
+# Training-set means and standard deviations, loaded once
+feature_encoder = FeatureEncoder.load(os.environ.get('LUNG_FEATURE_STATS', 'lung_feature_stats.json'))
+
+REQUIRED_FIELDS = ['GENDER', 'AGE', 'SMOKING', 'YELLOW_FINGERS', 'ANXIETY', 
+                   'PEER_PRESSURE', 'CHRONIC DISEASE', 'FATIGUE', 'ALLERGY', 
+                   'WHEEZING', 'ALCOHOL', 'COUGHING', 'SHORTNESS OF BREATH', 
+                   'SWALLOWING DIFFICULTY', 'CHEST PAIN']
 
 def preprocess_input(data):
     """
-    Preprocess the input data similar to training process
+    Preprocess the input data similar to training process.
+    Accepts one record or a list of records and returns an (N, 15) tensor,
+    z-scored with the training statistics (age groups come from
+    lung_features.encode_age, the vectorized groupAge of the training code).
     """
-    # Convert gender from string to binary (M=1, F=0)
-    if 'GENDER' in data:
-        data['GENDER'] = 1 if data['GENDER'].upper() == 'M' else 0
-    
-    # Convert boolean fields to 1/2 format
-    binary_fields = ['SMOKING', 'YELLOW_FINGERS', 'ANXIETY', 'PEER_PRESSURE', 
-                    'CHRONIC DISEASE', 'FATIGUE', 'ALLERGY', 'WHEEZING', 
-                    'ALCOHOL', 'COUGHING', 'SHORTNESS OF BREATH', 
-                    'SWALLOWING DIFFICULTY', 'CHEST PAIN']
-    
-    for field in binary_fields:
-        if field in data:
-            # Convert from any format to 1/2 (1=No, 2=Yes)
-            value = data[field]
-            if isinstance(value, str):
-                data[field] = 2 if value.upper() in ['YES', 'Y', 'TRUE', '1', '2'] else 1
-            else:
-                data[field] = 2 if value else 1
-    
-    # Process age
-    if 'AGE' in data:
-        data['age_group'] = groupAge(data['AGE'])
-        del data['AGE']
-    
-    # Convert to dataframe for easier processing
-    df = pd.DataFrame([data])
-    
-    # Z-score normalization (matching training pipeline)
-    numeric_cols = df.select_dtypes(include=['int64', 'float64']).columns
-    df[numeric_cols] = df[numeric_cols].apply(stats.zscore)
-    
-    # Convert to tensor
-    features = torch.tensor(df.values, dtype=torch.float32)
-    return features
+    records = data if isinstance(data, list) else [data]
+    features = feature_encoder.encode_records(records)
+    return torch.from_numpy(features)
 
-# Load the model
-form_model = None
+def missing_field(record):
+    for field in REQUIRED_FIELDS:
+        if field not in record:
+            return field
+    return None
 
-def load_model():
-    global form_model
+# Serve a BatchNorm-folded, dropout-free TorchScript engine; LUNG_INT8=1 quantizes it
+LUNG_INT8 = os.environ.get('LUNG_INT8', '0') == '1'
+LUNG_ENGINE_PATH = os.environ.get('LUNG_ENGINE_PATH')  # optional prebuilt lung_model.py export
+
+def load_form_model(path):
+    if path == LUNG_ENGINE_PATH:
+        return load_engine(path)
+
+    # Load form-based model
+    net = ANNnet()
+    if os.path.exists(path):
+        net.load_state_dict(torch.load(path, map_location=torch.device('cpu')))
+    else:
+        print(f"Warning: Form model file {path} does not exist")
+    net.eval()
+
+    engine = build_inference_model(net, quantize=LUNG_INT8)
+    atol = PARITY_ATOL_INT8 if LUNG_INT8 else PARITY_ATOL
+    max_abs_diff, agreement, passed = check_parity(net, engine, atol=atol)
+    if not passed:
+        # Serve the slower eager model rather than an engine that disagrees with it
+        print(f"Lung engine parity check failed (max |dp| = {max_abs_diff:.2e}, tolerance {atol:.0e}, "
+              f"decision agreement {agreement*100:.2f}%); serving the eager model")
+        return net
+    return engine
+
+# The shared registry loads the model on first use and reloads it if the file changes
+registry.register('lung', LUNG_ENGINE_PATH or "trained_model.pth", load_form_model)
+
+def get_form_model():
     try:
-        # Load form-based model
-        form_model = ANNnet()
-        form_model_path = "trained_model.pth"
-        if os.path.exists(form_model_path):
-            form_model.load_state_dict(torch.load(form_model_path, map_location=torch.device('cpu')))
-            form_model.eval()
-            print("Form model loaded successfully!")
-        else:
-            print(f"Warning: Form model file {form_model_path} does not exist")
-        
-        return True
+        return registry.get('lung')
     except Exception as e:
         print(f"Error loading model: {e}")
-        return False
+        return None
+
+def load_model():
+    return get_form_model() is not None
 
 @app.route('/predict_form', methods=['POST'])
 def predict():
     # Check if model is loaded
-    global form_model
+    form_model = get_form_model()
     if form_model is None:
-        if not load_model():
-            return jsonify({'error': 'Model could not be loaded'}), 500
+        return jsonify({'error': 'Model could not be loaded'}), 500
     
     try:
         # Get data from request
         data = request.json
         
         # Validate that we have the required fields
-        required_fields = ['GENDER', 'AGE', 'SMOKING', 'YELLOW_FINGERS', 'ANXIETY', 
-                          'PEER_PRESSURE', 'CHRONIC DISEASE', 'FATIGUE', 'ALLERGY', 
-                          'WHEEZING', 'ALCOHOL', 'COUGHING', 'SHORTNESS OF BREATH', 
-                          'SWALLOWING DIFFICULTY', 'CHEST PAIN']
-        
-        for field in required_fields:
-            if field not in data:
-                return jsonify({'error': f'Missing required field: {field}'}), 400
+        field = missing_field(data)
+        if field is not None:
+            return jsonify({'error': f'Missing required field: {field}'}), 400
         
         # Preprocess the input
-        input_tensor = preprocess_input(data)
+        with metrics.stage('preprocess'):
+            input_tensor = preprocess_input(data)
         
         # Make prediction
-        with torch.no_grad():
+        with torch.no_grad(), metrics.stage('forward'):
             output = form_model(input_tensor)
             probability = torch.sigmoid(output).item()
             
@@ -183,6 +116,10 @@ def predict():
                 
             prediction = "YES" if probability > 0.5 else "NO"
         
+        audit.record(endpoint='predict_form', inputs=dict(data), prediction=prediction,
+                     probability=float(probability), model_version=registry.version('lung'),
+                     timings=metrics.request_timings())
+        
         # Return the result
         return jsonify({
             'prediction': prediction,
@@ -193,9 +130,127 @@ def predict():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Same row cap as the thyroid batch endpoint
+BATCH_MAX_ROWS = int(os.environ.get('BATCH_MAX_ROWS', 100000))
+
+@app.route('/predict_form_batch', methods=['POST'])
+def predict_batch():
+    form_model = get_form_model()
+    if form_model is None:
+        return jsonify({'error': 'Model could not be loaded'}), 500
+
+    try:
+        # Accept either a bare list of records or {"records": [...]}
+        data = request.json
+        records = data.get('records') if isinstance(data, dict) else data
+        if not isinstance(records, list) or not records:
+            return jsonify({'error': 'Expected a non-empty list of records'}), 400
+        if len(records) > BATCH_MAX_ROWS:
+            return jsonify({'error': f'At most {BATCH_MAX_ROWS} records per batch'}), 413
+
+        for i, record in enumerate(records):
+            field = missing_field(record)
+            if field is not None:
+                return jsonify({'error': f'Missing required field in record {i}: {field}'}), 400
+
+        # Encode all records into one matrix and score them in one forward pass
+        with metrics.stage('preprocess_batch'):
+            input_tensor = preprocess_input(records)
+        with torch.no_grad(), metrics.stage('forward_batch'):
+            probabilities = torch.sigmoid(form_model(input_tensor)).squeeze(1).numpy()
+        probabilities = np.nan_to_num(probabilities, nan=0.5)
+        audit.record(endpoint='predict_form_batch', inputs_digest=batch_digest(records), rows=len(records),
+                     probabilities=probabilities,
+                     model_version=registry.version('lung'), timings=metrics.request_timings())
+
+        return jsonify({
+            'predictions': [
+                {
+                    'prediction': "YES" if probability > 0.5 else "NO",
+                    'probability': float(probability)
+                }
+                for probability in probabilities
+            ]
+        })
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/predict_form_whatif', methods=['POST'])
+def predict_whatif():
+    """
+    Score every yes/no combination of the symptoms in "vary" (default: all 13)
+    on top of "record" in one forward pass. probabilities[i] is the risk with
+    vary[j] set to yes wherever bit j of i is set.
+    """
+    form_model = get_form_model()
+    if form_model is None:
+        return jsonify({'error': 'Model could not be loaded'}), 500
+
+    try:
+        data = request.json or {}
+        record = data.get('record', data)
+        vary = data.get('vary') or BINARY_FIELDS
+
+        for field in ('GENDER', 'AGE'):
+            if field not in record:
+                return jsonify({'error': f'Missing required field: {field}'}), 400
+        unknown = [field for field in vary if field not in BINARY_FIELDS]
+        if unknown:
+            return jsonify({'error': f'Can only vary yes/no symptoms, not: {", ".join(map(str, unknown))}'}), 400
+        if len(set(vary)) != len(vary):
+            return jsonify({'error': 'Fields in vary must be unique'}), 400
+        field = next((f for f in BINARY_FIELDS if f not in vary and f not in record), None)
+        if field is not None:
+            return jsonify({'error': f'Missing required field: {field}'}), 400
+
+        with metrics.stage('whatif_encode'):
+            settings, features = feature_encoder.encode_combinations(record, vary)
+        with torch.no_grad(), metrics.stage('whatif_forward'):
+            probabilities = torch.sigmoid(form_model(torch.from_numpy(features))).squeeze(1).numpy()
+        probabilities = np.nan_to_num(probabilities, nan=0.5).astype(np.float64)
+
+        # The base record's own row, then the effect of flipping each field from there
+        base_index = sum(1 << j for j, name in enumerate(vary) if encode_binary(record.get(name, 1)) == 2)
+        base_probability = probabilities[base_index]
+
+        # Average effect of yes versus no across all combinations of the other fields
+        yes_mean = (settings.T @ probabilities) / settings.sum(axis=0)
+        no_mean = ((~settings).T @ probabilities) / (~settings).sum(axis=0)
+
+        sensitivity = sorted((
+            {
+                'field': name,
+                'average_effect': float(yes_mean[j] - no_mean[j]),
+                'toggle_effect': float(probabilities[base_index ^ (1 << j)] - base_probability),
+                'base_value': 'YES' if base_index >> j & 1 else 'NO'
+            }
+            for j, name in enumerate(vary)
+        ), key=lambda entry: abs(entry['average_effect']), reverse=True)
+
+        lowest, highest = int(np.argmin(probabilities)), int(np.argmax(probabilities))
+        audit.record(endpoint='predict_form_whatif', inputs=dict(record), vary=list(vary),
+                     base_probability=float(base_probability), combinations=len(probabilities),
+                     model_version=registry.version('lung'), timings=metrics.request_timings())
+        response = {
+            'fields': list(vary),
+            'base_index': base_index,
+            'base_probability': float(base_probability),
+            'sensitivity': sensitivity,
+            'lowest': {'index': lowest, 'probability': float(probabilities[lowest])},
+            'highest': {'index': highest, 'probability': float(probabilities[highest])},
+            'combinations': len(probabilities)
+        }
+        if data.get('include_table', True):
+            response['probabilities'] = [round(float(p), 6) for p in probabilities]
+        return jsonify(response)
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/health', methods=['GET'])
 def health_check():
-    return jsonify({'status': 'ok'})
+    return jsonify({'status': 'ok', 'models': registry.stats()})
 
 if __name__ == '__main__':
     # Load models at startup
@@ -0,0 +1,160 @@
+"""
+Score a large lung survey CSV with the lung cancer model.
+
+Reads the CSV in chunks, applies the same field conversions as the
+/predict_form route (see lung_features.py), scores each chunk in large tensor
+batches on a process pool and appends probabilities to the output CSV as
+chunks finish, so memory stays flat regardless of input size.
+
+The inference engine is built once in the parent and checked against the
+eager model with lung_model.check_parity before any row is scored; workers
+load that checked engine. --engine uses an existing lung_model.py export
+instead, which was checked when it was saved.
+
+Usage:
+    python lung_batch_score.py survey.csv scores.csv --workers 4
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import torch
+
+from lung_features import BINARY_FIELDS, CSV_ALIASES, DEFAULT_STATS_PATH, FeatureEncoder
+from lung_model import (DEFAULT_WEIGHTS_PATH, PARITY_ATOL, PARITY_ATOL_INT8, build_inference_model,
+                        check_parity, load_eager_model, load_engine)
+
+INPUT_FIELDS = ['GENDER', 'AGE'] + BINARY_FIELDS
+
+# Per-process state, set up once by _init_worker
+_engine = None
+_encoder = None
+_batch_size = None
+
+
+def _init_worker(engine_path, stats_path, batch_size):
+    global _engine, _encoder, _batch_size
+    # One thread per process; the pool provides the parallelism
+    torch.set_num_threads(1)
+    _engine = load_engine(engine_path)
+    _encoder = FeatureEncoder.load(stats_path)
+    _batch_size = batch_size
+
+
+def _score_chunk(columns, n_rows):
+    features = torch.from_numpy(_encoder.encode_columns(columns, n_rows))
+    probabilities = np.empty(n_rows, dtype=np.float32)
+    with torch.no_grad():
+        for start in range(0, n_rows, _batch_size):
+            batch = features[start:start + _batch_size]
+            probabilities[start:start + len(batch)] = torch.sigmoid(_engine(batch)).squeeze(1).numpy()
+    return probabilities
+
+
+def _chunk_columns(chunk):
+    """Pull just the model's input columns out as plain arrays (cheap to pickle)."""
+    chunk.columns = [c.strip() for c in chunk.columns]
+    columns = {}
+    for field in INPUT_FIELDS:
+        name = field if field in chunk.columns else CSV_ALIASES.get(field, field)
+        if name not in chunk.columns:
+            raise KeyError(f"Missing required column: {field}")
+        columns[field] = chunk[name].to_numpy()
+    return columns
+
+
+def build_checked_engine(weights_path, int8, engine_path):
+    """Build the engine, save it to engine_path and return True if it passes the parity check."""
+    eager = load_eager_model(weights_path)
+    engine = build_inference_model(eager, quantize=int8)
+    atol = PARITY_ATOL_INT8 if int8 else PARITY_ATOL
+    max_abs_diff, agreement, passed = check_parity(eager, engine, atol=atol)
+    print(f"Parity: max |dp| = {max_abs_diff:.2e}, decision agreement = {agreement*100:.2f}%", file=sys.stderr)
+    if not passed:
+        print(f"Parity check failed (tolerance {atol:.0e}); not scoring", file=sys.stderr)
+        return False
+    engine.save(engine_path)
+    return True
+
+
+def _write_chunk(output, chunk, probabilities, id_column, write_header):
+    result = pd.DataFrame({
+        'probability': probabilities,
+        'prediction': np.where(probabilities > 0.5, 'YES', 'NO'),
+    })
+    if id_column:
+        result.insert(0, id_column, chunk[id_column].to_numpy())
+    result.to_csv(output, header=write_header, index=False, float_format='%.6f')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Batch score a lung survey CSV.')
+    parser.add_argument('input', help='input CSV with /predict_form fields as columns')
+    parser.add_argument('output', help='output CSV of probabilities, one row per input row')
+    parser.add_argument('--id-column', help='input column to copy into the output')
+    parser.add_argument('--chunksize', type=int, default=100000, help='rows read per chunk')
+    parser.add_argument('--batch-size', type=int, default=8192, help='rows per forward pass')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--weights', default=DEFAULT_WEIGHTS_PATH)
+    parser.add_argument('--stats', default=DEFAULT_STATS_PATH)
+    parser.add_argument('--int8', action='store_true', help='use the int8 quantized engine')
+    parser.add_argument('--engine', help='score with this lung_model.py export instead of building one')
+    args = parser.parse_args()
+
+    engine_dir = None
+    engine_path = args.engine
+    if engine_path is None:
+        engine_dir = tempfile.TemporaryDirectory(prefix='lung-engine-')
+        engine_path = os.path.join(engine_dir.name, 'engine.pt')
+        if not build_checked_engine(args.weights, args.int8, engine_path):
+            sys.exit(1)
+
+    # Bound the chunks in flight so a slow writer can't let memory grow
+    max_in_flight = args.workers * 2
+    in_flight = deque()
+    rows_done = 0
+    started = time.perf_counter()
+    last_report = started
+
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker,
+                             initargs=(engine_path, args.stats, args.batch_size)) as pool, \
+            open(args.output, 'w', newline='') as output:
+
+        def drain_one():
+            nonlocal rows_done, last_report
+            chunk, future = in_flight.popleft()
+            _write_chunk(output, chunk, future.result(), args.id_column, write_header=rows_done == 0)
+            rows_done += len(chunk)
+
+            now = time.perf_counter()
+            if now - last_report >= 5:
+                print(f"{rows_done} rows, {rows_done / (now - started):,.0f} rows/s", file=sys.stderr)
+                last_report = now
+
+        for chunk in pd.read_csv(args.input, chunksize=args.chunksize):
+            columns = _chunk_columns(chunk)
+            # Keep only what the writer needs from the chunk
+            kept = chunk[[args.id_column]] if args.id_column else chunk.iloc[:, :0]
+            in_flight.append((kept, pool.submit(_score_chunk, columns, len(chunk))))
+            if len(in_flight) >= max_in_flight:
+                drain_one()
+
+        while in_flight:
+            drain_one()
+
+    if engine_dir is not None:
+        engine_dir.cleanup()
+
+    elapsed = time.perf_counter() - started
+    rate = rows_done / elapsed if elapsed > 0 else 0.0
+    print(f"Scored {rows_done} rows in {elapsed:.1f}s ({rate:,.0f} rows/s) -> {args.output}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
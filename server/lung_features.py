@@ -0,0 +1,159 @@
+import json
+import sys
+
+import numpy as np
+
+# Feature order used when the model was trained (see the training notebook).
+# The survey CSV calls ALCOHOL "ALCOHOL CONSUMING"; the API uses ALCOHOL.
+FEATURE_COLUMNS = ['GENDER', 'SMOKING', 'YELLOW_FINGERS', 'ANXIETY', 'PEER_PRESSURE',
+                   'CHRONIC DISEASE', 'FATIGUE', 'ALLERGY', 'WHEEZING', 'ALCOHOL',
+                   'COUGHING', 'SHORTNESS OF BREATH', 'SWALLOWING DIFFICULTY',
+                   'CHEST PAIN', 'age_group']
+
+BINARY_FIELDS = ['SMOKING', 'YELLOW_FINGERS', 'ANXIETY', 'PEER_PRESSURE',
+                 'CHRONIC DISEASE', 'FATIGUE', 'ALLERGY', 'WHEEZING',
+                 'ALCOHOL', 'COUGHING', 'SHORTNESS OF BREATH',
+                 'SWALLOWING DIFFICULTY', 'CHEST PAIN']
+
+# Column names in the raw survey CSV, where they differ from the API
+CSV_ALIASES = {'ALCOHOL': 'ALCOHOL CONSUMING'}
+
+YES_VALUES = {'YES', 'Y', 'TRUE', '2'}
+
+# The training code's groupAge buckets: <10 -> 0, <20 -> 1, ..., >=80 -> 8
+AGE_BINS = np.arange(10, 90, 10)
+
+DEFAULT_STATS_PATH = 'lung_feature_stats.json'
+
+
+def encode_binary(value):
+    """Convert one field to the survey's 1/2 coding (1=No, 2=Yes)."""
+    if isinstance(value, str):
+        return 2 if value.strip().upper() in YES_VALUES else 1
+    if isinstance(value, (bool, np.bool_)):
+        return 2 if value else 1
+    if value in (1, 2):
+        # Already in survey coding, as sent by the React form
+        return int(value)
+    return 2 if value else 1
+
+
+def encode_gender(value):
+    if isinstance(value, str):
+        return 1 if value.strip().upper() == 'M' else 0
+    return 1 if value == 1 else 0
+
+
+def _encode_column(values, scalar_fn):
+    if not isinstance(values, np.ndarray):
+        # Request fields can mix bools, numbers and strings; a plain asarray
+        # would promote them to one type (True -> 1, 1 -> '1') before encoding
+        values = np.asarray(values, dtype=object)
+    if values.dtype.kind in 'iuf':
+        # Fast path for homogeneous numeric columns, e.g. CSV chunks already coded 1/2
+        if scalar_fn is encode_gender:
+            return (values == 1).astype(np.float32)
+        return np.where((values == 1) | (values == 0), 1, 2).astype(np.float32)
+    return np.fromiter((scalar_fn(v) for v in values), dtype=np.float32, count=len(values))
+
+
+def encode_age(values):
+    """Vectorized groupAge from the training code: np.digitize over AGE_BINS."""
+    ages = np.asarray(values, dtype=np.float64)
+    return np.digitize(ages, AGE_BINS).astype(np.float32)
+
+
+class FeatureEncoder:
+    """
+    Encodes lung survey records into the z-scored feature matrix the model
+    was trained on, using the training-set means and standard deviations
+    instead of z-scoring the incoming rows themselves.
+    """
+
+    def __init__(self, mean, std, columns=FEATURE_COLUMNS):
+        self.columns = list(columns)
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.std = np.asarray(std, dtype=np.float32)
+        # Precompute the reciprocal so encoding is a subtract and a multiply
+        self.inv_std = (1.0 / np.where(self.std == 0, 1.0, self.std)).astype(np.float32)
+
+    @classmethod
+    def load(cls, path=DEFAULT_STATS_PATH):
+        with open(path, 'r') as f:
+            stats = json.load(f)
+        return cls(stats['mean'], stats['std'], stats.get('columns', FEATURE_COLUMNS))
+
+    def save(self, path=DEFAULT_STATS_PATH):
+        with open(path, 'w') as f:
+            json.dump({
+                'columns': self.columns,
+                'mean': [float(v) for v in self.mean],
+                'std': [float(v) for v in self.std],
+            }, f, indent=2)
+
+    @classmethod
+    def fit_csv(cls, csv_path):
+        """Compute the statistics from the raw training survey CSV."""
+        import pandas as pd
+
+        data = pd.read_csv(csv_path)
+        data.columns = [c.strip() for c in data.columns]
+        raw = raw_matrix_from_columns({name: data[CSV_ALIASES.get(name, name)].to_numpy()
+                                       for name in BINARY_FIELDS + ['GENDER', 'AGE']}, len(data))
+        # Population std, matching scipy.stats.zscore
+        return cls(raw.mean(axis=0), raw.std(axis=0))
+
+    def transform(self, raw):
+        """Z-score a raw (N, 15) matrix in place and return it."""
+        raw -= self.mean
+        raw *= self.inv_std
+        return raw
+
+    def encode_columns(self, columns, n_rows):
+        """Encode a dict of column arrays (API field names plus AGE)."""
+        return self.transform(raw_matrix_from_columns(columns, n_rows))
+
+    def encode_records(self, records):
+        """Encode a list of request dicts into an (N, 15) float32 matrix."""
+        fields = ['GENDER', 'AGE'] + BINARY_FIELDS
+        columns = {field: [record.get(field) for record in records] for field in fields}
+        return self.encode_columns(columns, len(records))
+
+    def encode_combinations(self, record, fields):
+        """
+        Encode every yes/no combination of the given binary fields on top of
+        record. Row i sets fields[j] to yes when bit j of i is set, so row
+        indices double as bitmasks. Returns ((2^k, k) bool settings, (2^k, 15) features).
+        """
+        n_rows = 1 << len(fields)
+        settings = (np.arange(n_rows)[:, None] >> np.arange(len(fields))) & 1 == 1
+
+        base = {name: [record.get(name, 1)] for name in ['GENDER', 'AGE'] + BINARY_FIELDS}
+        raw = np.repeat(raw_matrix_from_columns(base, 1), n_rows, axis=0)
+        for j, field in enumerate(fields):
+            raw[:, FEATURE_COLUMNS.index(field)] = np.where(settings[:, j], 2, 1)
+        return settings, self.transform(raw)
+
+
+def raw_matrix_from_columns(columns, n_rows):
+    """Build the unscaled (N, 15) matrix in FEATURE_COLUMNS order."""
+    raw = np.empty((n_rows, len(FEATURE_COLUMNS)), dtype=np.float32)
+    for i, name in enumerate(FEATURE_COLUMNS):
+        if name == 'GENDER':
+            raw[:, i] = _encode_column(columns['GENDER'], encode_gender)
+        elif name == 'age_group':
+            raw[:, i] = encode_age(columns['AGE'])
+        else:
+            raw[:, i] = _encode_column(columns[name], encode_binary)
+    return raw
+
+
+if __name__ == '__main__':
+    # Usage: python lung_features.py "survey lung cancer.csv" [output.json]
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} <training csv> [output json]")
+        sys.exit(1)
+    encoder = FeatureEncoder.fit_csv(sys.argv[1])
+    output_path = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_STATS_PATH
+    encoder.save(output_path)
+    print(f"Saved feature statistics to {output_path}")
@@ -0,0 +1,214 @@
+import argparse
+import sys
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+DEFAULT_WEIGHTS_PATH = 'trained_model.pth'
+DEFAULT_ENGINE_PATH = 'lung_inference.pt'
+
+# Max allowed probability difference between the eager model and its engine
+PARITY_ATOL = 1e-4
+PARITY_ATOL_INT8 = 2e-2
+
+# Define the neural network architecture used during training
+class ANNnet(nn.Module):
+    def __init__(self, input_features=15):  # Adjust input features based on your model
+        super().__init__()
+
+        self.input = nn.Linear(input_features, 256)
+
+        self.fc1 = nn.Linear(256, 256)
+        self.bn1 = nn.BatchNorm1d(256)
+
+        self.fc2 = nn.Linear(256, 256)
+        self.bn2 = nn.BatchNorm1d(256)
+
+        self.fc3 = nn.Linear(256, 256)
+        self.bn3 = nn.BatchNorm1d(256)
+
+        self.fc4 = nn.Linear(256, 256)
+        self.bn4 = nn.BatchNorm1d(256)
+
+        self.fc5 = nn.Linear(256, 256)
+        self.bn5 = nn.BatchNorm1d(256)
+
+        self.output = nn.Linear(256, 1)
+
+    def forward(self, x):
+        # Dropout only while training; after eval() the output is deterministic
+        x = F.relu(self.input(x))
+        x = F.dropout(x, .5, training=self.training)
+
+        x = self.fc1(x)
+        x = self.bn1(x)
+        x = F.relu(x)
+        x = F.dropout(x, .5, training=self.training)
+
+        x = self.fc2(x)
+        x = self.bn2(x)
+        x = F.relu(x)
+        x = F.dropout(x, .5, training=self.training)
+
+        x = self.fc3(x)
+        x = self.bn3(x)
+        x = F.relu(x)
+        x = F.dropout(x, .5, training=self.training)
+
+        x = self.fc4(x)
+        x = self.bn4(x)
+        x = F.relu(x)
+        x = F.dropout(x, .5, training=self.training)
+
+        x = self.fc5(x)
+        x = self.bn5(x)
+        x = F.relu(x)
+        x = F.dropout(x, .5, training=self.training)
+
+        return self.output(x)
+
+
+class InferenceNet(nn.Module):
+    """ANNnet with each BatchNorm folded into its Linear layer and no dropout."""
+
+    def __init__(self, input_features=15):
+        super().__init__()
+        self.input = nn.Linear(input_features, 256)
+        self.hidden = nn.ModuleList([nn.Linear(256, 256) for _ in range(5)])
+        self.output = nn.Linear(256, 1)
+
+    def forward(self, x):
+        x = F.relu(self.input(x))
+        for layer in self.hidden:
+            x = F.relu(layer(x))
+        return self.output(x)
+
+
+def load_eager_model(weights_path=DEFAULT_WEIGHTS_PATH):
+    net = ANNnet()
+    net.load_state_dict(torch.load(weights_path, map_location=torch.device('cpu')))
+    net.eval()
+    return net
+
+
+def fold_batchnorm(linear, bn):
+    """Return (weight, bias) of a Linear equivalent to linear followed by bn in eval mode."""
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    weight = linear.weight * scale[:, None]
+    bias = (linear.bias - bn.running_mean) * scale + bn.bias
+    return weight, bias
+
+
+def fold_model(net):
+    """Build an InferenceNet with the same eval-mode outputs as net."""
+    folded = InferenceNet(net.input.in_features)
+    pairs = [(net.fc1, net.bn1), (net.fc2, net.bn2), (net.fc3, net.bn3),
+             (net.fc4, net.bn4), (net.fc5, net.bn5)]
+
+    with torch.no_grad():
+        folded.input.weight.copy_(net.input.weight)
+        folded.input.bias.copy_(net.input.bias)
+        for layer, (linear, bn) in zip(folded.hidden, pairs):
+            weight, bias = fold_batchnorm(linear, bn)
+            layer.weight.copy_(weight)
+            layer.bias.copy_(bias)
+        folded.output.weight.copy_(net.output.weight)
+        folded.output.bias.copy_(net.output.bias)
+
+    return folded.eval()
+
+
+def build_inference_model(net, quantize=False):
+    """
+    Fold BatchNorm, optionally apply dynamic int8 quantization to the 256x256
+    layers, and freeze the result with TorchScript.
+    """
+    folded = fold_model(net)
+
+    if quantize:
+        qconfig = torch.ao.quantization.default_dynamic_qconfig
+        folded = torch.ao.quantization.quantize_dynamic(
+            folded, {f'hidden.{i}': qconfig for i in range(len(folded.hidden))})
+
+    example = torch.zeros(1, folded.input.in_features)
+    with torch.no_grad():
+        scripted = torch.jit.trace(folded, example)
+    return torch.jit.freeze(scripted.eval())
+
+
+def load_engine(path=DEFAULT_ENGINE_PATH):
+    engine = torch.jit.load(path, map_location=torch.device('cpu'))
+    engine.eval()
+    return engine
+
+
+def check_parity(eager, engine, n_samples=2048, atol=1e-4, seed=0):
+    """
+    Compare engine against the eager model (eval mode, so dropout is off) on
+    random z-scored inputs. Returns (max_abs_diff, decision_agreement, passed).
+    """
+    generator = torch.Generator().manual_seed(seed)
+    inputs = torch.randn(n_samples, eager.input.in_features, generator=generator)
+
+    with torch.no_grad():
+        expected = torch.sigmoid(eager(inputs))
+        actual = torch.sigmoid(engine(inputs))
+
+    max_abs_diff = (expected - actual).abs().max().item()
+    agreement = ((expected > 0.5) == (actual > 0.5)).float().mean().item()
+    return max_abs_diff, agreement, max_abs_diff <= atol
+
+
+def random_eager_model(seed=0):
+    """An eval-mode ANNnet with random weights and non-trivial BatchNorm statistics."""
+    torch.manual_seed(seed)
+    net = ANNnet()
+    with torch.no_grad():
+        for bn in (net.bn1, net.bn2, net.bn3, net.bn4, net.bn5):
+            bn.running_mean.normal_(0.0, 0.5)
+            bn.running_var.uniform_(0.5, 2.0)
+            bn.weight.normal_(1.0, 0.2)
+            bn.bias.normal_(0.0, 0.2)
+    return net.eval()
+
+
+def self_test():
+    """Check fp32 and int8 engine parity on a randomly initialized model; returns True if both pass."""
+    eager = random_eager_model()
+    ok = True
+    for quantize, atol in ((False, PARITY_ATOL), (True, PARITY_ATOL_INT8)):
+        max_abs_diff, agreement, passed = check_parity(eager, build_inference_model(eager, quantize), atol=atol)
+        print(f"{'int8' if quantize else 'fp32'}: max |dp| = {max_abs_diff:.2e}, "
+              f"decision agreement = {agreement*100:.2f}% ({'ok' if passed else 'FAILED'})")
+        ok = ok and passed
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the lung model as a frozen inference engine.')
+    parser.add_argument('--weights', default=DEFAULT_WEIGHTS_PATH)
+    parser.add_argument('--output', default=DEFAULT_ENGINE_PATH)
+    parser.add_argument('--int8', action='store_true', help='dynamic int8 quantization of the 256x256 layers')
+    parser.add_argument('--atol', type=float, default=None,
+                        help='max allowed probability difference (default 1e-4, or 2e-2 with --int8)')
+    parser.add_argument('--self-test', action='store_true',
+                        help='check fp32 and int8 parity on random weights and exit')
+    args = parser.parse_args()
+
+    if args.self_test:
+        sys.exit(0 if self_test() else 1)
+
+    eager = load_eager_model(args.weights)
+    engine = build_inference_model(eager, quantize=args.int8)
+
+    atol = args.atol if args.atol is not None else (PARITY_ATOL_INT8 if args.int8 else PARITY_ATOL)
+    max_abs_diff, agreement, passed = check_parity(eager, engine, atol=atol)
+    print(f"Parity: max |dp| = {max_abs_diff:.2e}, decision agreement = {agreement*100:.2f}%")
+
+    if not passed:
+        print(f"Parity check failed (tolerance {atol:.0e}); not saving {args.output}")
+        sys.exit(1)
+
+    engine.save(args.output)
+    print(f"Saved inference engine to {args.output}")
@@ -0,0 +1,333 @@
+"""
+Lightweight per-stage timing for the Flask services, exposed in the
+Prometheus text format on /metrics.
+
+Each service creates one Metrics object. Wrap a stage in
+`with metrics.stage('decode'):` to record its latency in a histogram, and
+call `metrics.instrument(app)` to get per-endpoint request latency, in-flight
+counts and the /metrics route. Existing components that already keep stats
+(batchers, caches, the LLM client, the model registry) are folded in with
+`metrics.collect(prefix, stats_fn)`; their numbers are read only when
+/metrics is scraped.
+
+Recording a sample is a bisect plus a few additions under a per-histogram
+lock, so the hot path cost is on the order of a microsecond.
+
+Under serve.py every pre-forked worker has its own counters, and a scrape
+reaches whichever worker accepts it. When METRICS_DIR is set (serve.py sets
+it), each serving worker writes a snapshot of its metrics to
+<METRICS_DIR>/<service>-<pid>.json every METRICS_WRITE_SECONDS, and /metrics
+merges all of them: histograms and response counters are summed over every
+worker, including ones that have exited, so totals never go backwards when
+a worker is restarted; in-flight counts and collected gauges are reported
+per live worker with a worker="<pid>" label.
+"""
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, g, has_request_context, request
+
+# Seconds between a worker's metric snapshots in METRICS_DIR
+WRITE_INTERVAL = float(os.environ.get('METRICS_WRITE_SECONDS', 5.0))
+
+# Histogram bucket upper bounds in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.sum, self.count
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+
+def _metric_name(*parts):
+    name = '_'.join(str(part) for part in parts if part)
+    return ''.join(c if c.isalnum() or c == '_' else '_' for c in name).lower()
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Metrics:
+    def __init__(self, service, shared_dir=None):
+        self.service = service
+        self.shared_dir = shared_dir if shared_dir is not None else os.environ.get('METRICS_DIR') or None
+        self._writer_pid = None
+        self._lock = threading.Lock()
+        self._stages = {}       # stage name -> Histogram
+        self._requests = {}     # endpoint -> Histogram
+        self._responses = {}    # (endpoint, status) -> count
+        self._in_flight = {}    # endpoint -> count
+        self._collectors = []   # (prefix, stats_fn)
+
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        for histogram in list(self._stages.values()) + list(self._requests.values()):
+            histogram.lock = threading.Lock()
+
+    def _histogram(self, table, key):
+        histogram = table.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = table.setdefault(key, Histogram())
+        return histogram
+
+    def observe(self, stage, seconds):
+        self._histogram(self._stages, stage).observe(seconds)
+
+    @contextmanager
+    def stage(self, name):
+        """Time the body of a with block as one sample of the named stage."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.observe(name, elapsed)
+            if has_request_context():
+                g.setdefault('_stage_timings', {})[name] = elapsed
+
+    def request_timings(self):
+        """Stage name -> milliseconds for the stages timed so far in the current request."""
+        timings = g.get('_stage_timings', {}) if has_request_context() else {}
+        return {name: round(seconds * 1000.0, 3) for name, seconds in timings.items()}
+
+    def timed(self, name):
+        """Decorator form of stage()."""
+        def decorator(fn):
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return fn(*args, **kwargs)
+            wrapper.__name__ = fn.__name__
+            wrapper.__doc__ = fn.__doc__
+            return wrapper
+        return decorator
+
+    def collect(self, prefix, stats_fn):
+        """Export the numeric values of stats_fn() as gauges named <service>_<prefix>_<key>."""
+        self._collectors.append((prefix, stats_fn))
+
+    def instrument(self, app, path='/metrics'):
+        """Track request latency and in-flight counts for app and add the metrics route."""
+
+        @app.before_request
+        def _start_timer():
+            self._ensure_writer()
+            g._metrics_started = time.perf_counter()
+            g._metrics_endpoint = request.endpoint or 'unknown'
+            with self._lock:
+                self._in_flight[g._metrics_endpoint] = self._in_flight.get(g._metrics_endpoint, 0) + 1
+
+        @app.teardown_request
+        def _stop_timer(error=None):
+            started = g.pop('_metrics_started', None)
+            endpoint = g.pop('_metrics_endpoint', None)
+            if started is None:
+                return
+            with self._lock:
+                self._in_flight[endpoint] -= 1
+            self._histogram(self._requests, endpoint).observe(time.perf_counter() - started)
+
+        @app.after_request
+        def _count_response(response):
+            key = (request.endpoint or 'unknown', response.status_code)
+            with self._lock:
+                self._responses[key] = self._responses.get(key, 0) + 1
+            return response
+
+        app.add_url_rule(path, 'metrics', lambda: Response(self.render(), mimetype='text/plain; version=0.0.4'))
+
+    def _ensure_writer(self):
+        # Started by the first request a worker serves, so only serving processes write snapshots
+        if self.shared_dir is None or self._writer_pid == os.getpid():
+            return
+        with self._lock:
+            if self._writer_pid == os.getpid():
+                return
+            self._writer_pid = os.getpid()
+        os.makedirs(self.shared_dir, exist_ok=True)
+        threading.Thread(target=self._write_loop, name=f'{self.service}-metrics', daemon=True).start()
+
+    def _write_loop(self):
+        while True:
+            time.sleep(WRITE_INTERVAL)
+            try:
+                self._write_snapshot()
+            except Exception as e:
+                print(f"Error writing {self.service} metrics snapshot: {e}")
+
+    def _snapshot_path(self, pid):
+        return os.path.join(self.shared_dir, f'{self.service}-{pid}.json')
+
+    def _write_snapshot(self, snapshot=None):
+        snapshot = snapshot or self.snapshot()
+        path = self._snapshot_path(snapshot['pid'])
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, path)
+
+    def snapshot(self):
+        """This process's metrics as plain JSON-serializable data."""
+        with self._lock:
+            stages = dict(self._stages)
+            requests = dict(self._requests)
+            responses = dict(self._responses)
+            in_flight = dict(self._in_flight)
+
+        families = {}
+        for prefix, stats_fn in self._collectors:
+            try:
+                self._collect_stats(families, prefix, stats_fn())
+            except Exception as e:
+                print(f"Error collecting {prefix} metrics: {e}")
+
+        return {
+            'pid': os.getpid(),
+            'stages': {name: histogram.snapshot() for name, histogram in stages.items()},
+            'requests': {name: histogram.snapshot() for name, histogram in requests.items()},
+            'responses': [[endpoint, status, count] for (endpoint, status), count in responses.items()],
+            'in_flight': in_flight,
+            'gauges': {name: [[list(labels), value] for labels, value in samples]
+                       for name, samples in families.items()},
+        }
+
+    def _snapshots(self):
+        """Own fresh snapshot plus the latest one from every other worker in shared_dir."""
+        own = self.snapshot()
+        if self.shared_dir is None:
+            return [own]
+        self._write_snapshot(own)
+        snapshots = [own]
+        for path in glob.glob(os.path.join(self.shared_dir, f'{self.service}-*.json')):
+            if path == self._snapshot_path(own['pid']):
+                continue
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                pass  # being replaced right now; picked up on the next scrape
+        return snapshots
+
+    @staticmethod
+    def _merge_histograms(snapshots, key):
+        merged = {}
+        for snapshot in snapshots:
+            for name, (counts, total, count) in snapshot[key].items():
+                previous = merged.get(name)
+                if previous is None:
+                    merged[name] = (list(counts), total, count)
+                else:
+                    merged[name] = ([a + b for a, b in zip(previous[0], counts)],
+                                    previous[1] + total, previous[2] + count)
+        return merged
+
+    def _render_histogram(self, lines, name, label_key, table):
+        lines.append(f'# TYPE {name} histogram')
+        for key, (counts, total, count) in sorted(table.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{_labels([(label_key, key), ("le", bound)])} {cumulative}')
+            lines.append(f'{name}_sum{_labels([(label_key, key)])} {total}')
+            lines.append(f'{name}_count{_labels([(label_key, key)])} {count}')
+
+    def _collect_stats(self, families, prefix, stats, labels=()):
+        """Flatten a stats dict into families: metric name -> list of (labels, value)."""
+        for key, value in stats.items():
+            if isinstance(value, bool):
+                value = int(value)
+            if isinstance(value, dict):
+                if value and all(isinstance(v, (int, float)) for v in value.values()):
+                    # A flat mapping like a size histogram becomes one labelled gauge
+                    samples = families.setdefault(_metric_name(self.service, prefix, key), [])
+                    samples.extend((list(labels) + [('key', k)], v) for k, v in value.items())
+                else:
+                    for sub_key, sub_value in value.items():
+                        if isinstance(sub_value, dict):
+                            self._collect_stats(families, _metric_name(prefix, key), sub_value,
+                                                list(labels) + [('name', sub_key)])
+            elif isinstance(value, (int, float)):
+                families.setdefault(_metric_name(self.service, prefix, key), []).append((labels, value))
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        snapshots = self._snapshots()
+        # Counters of exited workers still count; their gauges no longer apply
+        live = [snapshot for snapshot in snapshots
+                if snapshot['pid'] == os.getpid() or _process_alive(snapshot['pid'])]
+        per_worker = self.shared_dir is not None
+
+        def worker_labels(snapshot, labels):
+            return list(labels) + [('worker', snapshot['pid'])] if per_worker else list(labels)
+
+        lines = []
+        self._render_histogram(lines, _metric_name(self.service, 'stage_seconds'), 'stage',
+                               self._merge_histograms(snapshots, 'stages'))
+        self._render_histogram(lines, _metric_name(self.service, 'request_seconds'), 'endpoint',
+                               self._merge_histograms(snapshots, 'requests'))
+
+        responses = {}
+        for snapshot in snapshots:
+            for endpoint, status, count in snapshot['responses']:
+                responses[(endpoint, status)] = responses.get((endpoint, status), 0) + count
+        name = _metric_name(self.service, 'responses_total')
+        lines.append(f'# TYPE {name} counter')
+        for (endpoint, status), count in sorted(responses.items()):
+            lines.append(f'{name}{_labels([("endpoint", endpoint), ("status", status)])} {count}')
+
+        name = _metric_name(self.service, 'in_flight_requests')
+        lines.append(f'# TYPE {name} gauge')
+        for snapshot in live:
+            for endpoint, count in sorted(snapshot['in_flight'].items()):
+                lines.append(f'{name}{_labels(worker_labels(snapshot, [("endpoint", endpoint)]))} {count}')
+
+        families = {}
+        for snapshot in live:
+            for name, samples in snapshot['gauges'].items():
+                families.setdefault(name, []).extend(
+                    (worker_labels(snapshot, [tuple(label) for label in labels]), value)
+                    for labels, value in samples)
+        for name, samples in families.items():
+            lines.append(f'# TYPE {name} gauge')
+            lines.extend(f'{name}{_labels(labels)} {value}' for labels, value in samples)
+
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,209 @@
+"""
+Process-wide registry of the diagnostic models.
+
+Models are registered with a path and a loader, loaded on first use, and
+tracked by how much resident memory loading them added. When the total goes
+over the memory budget (MODEL_MEMORY_BUDGET_MB), the least recently used
+models are dropped and reloaded the next time they're needed. If a model's
+file changes on disk, the next request that asks for it after the size and
+mtime have stayed the same across two checks loads the new version and swaps
+it in atomically; requests already holding the old model keep using it until
+they finish. If that reload fails (e.g. the file is still being copied),
+the old model keeps serving and the same file version isn't retried; only a
+model that was never loaded raises to the caller.
+"""
+import gc
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# How often to stat model files for changes
+DEFAULT_CHECK_INTERVAL = 2.0
+
+
+def _rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+
+def _file_version(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return f"{stat.st_size}-{int(stat.st_mtime)}"
+
+
+class _Entry:
+    def __init__(self, name, path, loader, check_interval):
+        self.name = name
+        self.path = path
+        self.loader = loader
+        self.check_interval = check_interval
+
+        self.model = None
+        self.version = None
+        self.size = 0
+        self.loads = 0
+        self.last_check = 0.0
+        # Version seen on the last check, reloaded once it is seen twice
+        self.pending_version = None
+        # Version whose reload failed; not retried until the file changes again
+        self.failed_version = None
+        self.reload_failures = 0
+        self.load_lock = threading.Lock()
+
+
+class ModelRegistry:
+    def __init__(self, memory_budget_bytes=None):
+        self.memory_budget = memory_budget_bytes
+        self._entries = {}
+        self._loaded = OrderedDict()  # name -> None, least recently used first
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        for entry in self._entries.values():
+            entry.load_lock = threading.Lock()
+
+    def register(self, name, path, loader, check_interval=DEFAULT_CHECK_INTERVAL):
+        """Register loader(path) under name. Registering the same name again is a no-op."""
+        with self._lock:
+            if name not in self._entries:
+                self._entries[name] = _Entry(name, path, loader, check_interval)
+
+    def get(self, name):
+        """Return the model, loading or reloading it if needed."""
+        entry = self._entries[name]
+        model = entry.model
+
+        if model is None:
+            model = self._load(entry)
+        elif self._changed_on_disk(entry):
+            try:
+                model = self._load(entry)
+            except Exception as e:
+                entry.failed_version = entry.pending_version
+                entry.reload_failures += 1
+                print(f"Error reloading model {name} from {entry.path}, keeping the loaded version: {e}")
+
+        with self._lock:
+            if name in self._loaded:
+                self._loaded.move_to_end(name)
+        return model
+
+    def version(self, name):
+        """Version tag (size-mtime) of the loaded model, or of the file on disk if not loaded."""
+        entry = self._entries[name]
+        return entry.version or _file_version(entry.path)
+
+    def preload(self, *names):
+        for name in names or list(self._entries):
+            self.get(name)
+
+    def unload(self, name):
+        entry = self._entries[name]
+        with self._lock:
+            self._loaded.pop(name, None)
+            entry.model = None
+            entry.size = 0
+        gc.collect()
+
+    def _changed_on_disk(self, entry):
+        now = time.monotonic()
+        if now - entry.last_check < entry.check_interval:
+            return False
+        entry.last_check = now
+        version = _file_version(entry.path)
+        if version is None or version == entry.version or version == entry.failed_version:
+            return False
+        # Only reload once the file has stopped changing between two checks
+        stable = version == entry.pending_version
+        entry.pending_version = version
+        return stable
+
+    def _load(self, entry):
+        with entry.load_lock:
+            # Another thread may have finished loading while we waited
+            version = _file_version(entry.path)
+            if entry.model is not None and version == entry.version:
+                return entry.model
+
+            rss_before = _rss_bytes()
+            started = time.perf_counter()
+            model = entry.loader(entry.path)
+            elapsed = time.perf_counter() - started
+            size = max(_rss_bytes() - rss_before, 0)
+            if size == 0 and version is not None:
+                # Fall back to the file size when RSS isn't measurable
+                size = int(version.split('-')[0])
+
+            # Swap in the new model; callers holding the old one are unaffected
+            with self._lock:
+                entry.model = model
+                entry.version = version
+                entry.size = size
+                entry.loads += 1
+                entry.last_check = time.monotonic()
+                self._loaded[entry.name] = None
+                self._loaded.move_to_end(entry.name)
+
+            action = 'Reloaded' if entry.loads > 1 else 'Loaded'
+            print(f"{action} model {entry.name} from {entry.path} in {elapsed:.2f}s (~{size / 2**20:.1f} MB)")
+
+            self._evict(keep=entry.name)
+            return model
+
+    def _evict(self, keep):
+        if not self.memory_budget:
+            return
+
+        evicted = []
+        with self._lock:
+            while self._resident_bytes() > self.memory_budget:
+                victim = next((name for name in self._loaded if name != keep), None)
+                if victim is None:
+                    break
+                del self._loaded[victim]
+                entry = self._entries[victim]
+                entry.model = None
+                entry.size = 0
+                self.evictions += 1
+                evicted.append(victim)
+
+        if evicted:
+            gc.collect()
+            print(f"Evicted models {', '.join(evicted)} to stay under the memory budget")
+
+    def _resident_bytes(self):
+        return sum(self._entries[name].size for name in self._loaded)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'memory_budget_bytes': self.memory_budget,
+                'resident_bytes': self._resident_bytes(),
+                'evictions': self.evictions,
+                'models': {
+                    name: {
+                        'path': entry.path,
+                        'loaded': entry.model is not None,
+                        'version': entry.version,
+                        'size_bytes': entry.size,
+                        'loads': entry.loads,
+                        'reload_failures': entry.reload_failures,
+                    }
+                    for name, entry in self._entries.items()
+                },
+            }
+
+
+_budget_mb = float(os.environ.get('MODEL_MEMORY_BUDGET_MB', 0))
+registry = ModelRegistry(memory_budget_bytes=int(_budget_mb * 2**20) if _budget_mb > 0 else None)
@@ -0,0 +1,272 @@
+"""
+Pre-forking launcher for the diagnostic Flask apps.
+
+The parent process imports the app and loads its models once, freezes the
+garbage collector so reference-count bookkeeping doesn't dirty those pages,
+then forks worker processes that share the model weights copy-on-write and
+accept connections from one listening socket. Dead workers are restarted
+with exponential backoff; a worker slot whose process keeps dying within
+QUICK_EXIT_SECONDS of starting (e.g. because its models fail to load) is
+given up after MAX_QUICK_EXITS tries, and the launcher exits once no
+workers are left.
+
+Each worker serves with werkzeug's development server (make_server), so
+this is a dev-server prefork: it shares the model memory and spreads load
+over cores, but it has none of a production WSGI server's hardening
+(request timeouts, slow-client protection, graceful reloads). For
+production, run the apps under a real WSGI server with preloading, e.g.
+gunicorn --preload with a post_fork hook doing what run_worker does.
+
+Usage:
+    python serve.py thyroid --workers 4
+    python serve.py lung --workers 4 --port 5004
+    python serve.py brain --workers 2 --no-preload
+    python serve.py all --workers 2
+
+'all' mounts the three apps under /brain, /lung and /thyroid in one process;
+set MODEL_MEMORY_BUDGET_MB so the shared model registry keeps only the
+recently used models loaded.
+
+Each worker's /metrics covers all workers: they share snapshots through
+METRICS_DIR, a fresh temp directory unless set.
+
+Send SIGUSR1 to the parent (or pass --memory-report-interval) to print a
+per-worker memory report: RSS, PSS and how much of each is shared.
+"""
+import argparse
+import gc
+import glob
+import importlib
+import os
+import signal
+import socket
+import sys
+import tempfile
+import time
+import traceback
+
+from werkzeug.serving import make_server
+
+# modules, default port, preload by default
+APPS = {
+    'brain': (['brain'], 5002, False),
+    'lung': (['lung'], 5004, True),
+    'thyroid': (['thyroid'], 5003, True),
+    'all': (['brain', 'lung', 'thyroid'], 5001, False),
+}
+
+# Worker exit status when the app or its models fail to load
+EXIT_LOAD_FAILED = 3
+# A worker that exits sooner than this after starting counts as a quick exit
+QUICK_EXIT_SECONDS = 10.0
+# Give up on a worker slot after this many quick exits in a row
+MAX_QUICK_EXITS = 5
+# Restart delay after the first quick exit, doubling up to RESTART_BACKOFF_MAX
+RESTART_BACKOFF = 1.0
+RESTART_BACKOFF_MAX = 30.0
+
+SMAPS_FIELDS = ('Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty')
+
+
+def read_memory(pid):
+    """Return the smaps_rollup fields for pid, in kB."""
+    usage = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                name, _, rest = line.partition(':')
+                if name in SMAPS_FIELDS:
+                    usage[name] = int(rest.split()[0])
+    except OSError:
+        pass
+    return usage
+
+
+def memory_report(parent_pid, worker_pids):
+    rows = [('parent', parent_pid)] + [(f'worker {i}', pid) for i, pid in enumerate(worker_pids)]
+    lines = [f"{'process':<10} {'pid':>7} {'rss MB':>9} {'pss MB':>9} {'shared MB':>10} {'private MB':>11}"]
+    total_rss = total_pss = 0
+
+    for label, pid in rows:
+        usage = read_memory(pid)
+        if not usage:
+            continue
+        shared = usage.get('Shared_Clean', 0) + usage.get('Shared_Dirty', 0)
+        private = usage.get('Private_Clean', 0) + usage.get('Private_Dirty', 0)
+        total_rss += usage.get('Rss', 0)
+        total_pss += usage.get('Pss', 0)
+        lines.append(f"{label:<10} {pid:>7} {usage.get('Rss', 0)/1024:>9.1f} {usage.get('Pss', 0)/1024:>9.1f} "
+                     f"{shared/1024:>10.1f} {private/1024:>11.1f}")
+
+    # PSS splits shared pages between the processes mapping them, so its
+    # sum is the real footprint; the RSS sum counts shared weights N times
+    lines.append(f"total rss {total_rss/1024:.1f} MB, actual (pss) {total_pss/1024:.1f} MB")
+    return '\n'.join(lines)
+
+
+def load_app(app_name, preload_models):
+    module_names = APPS[app_name][0]
+    modules = [importlib.import_module(name) for name in module_names]
+    if preload_models:
+        from model_registry import registry
+        registry.preload()
+
+    if len(modules) == 1:
+        return modules[0].app
+
+    from werkzeug.middleware.dispatcher import DispatcherMiddleware
+    from flask import Flask
+    root = Flask('diagnostics')
+    return DispatcherMiddleware(root, {f'/{name}': module.app for name, module in zip(module_names, modules)})
+
+
+def _terminate_worker(*_):
+    # os._exit skips atexit, so write out queued audit records first
+    audit = sys.modules.get('audit')
+    if audit is not None:
+        audit.close_all()
+    os._exit(0)
+
+
+def run_worker(app, listener, host, port, threaded):
+    server = make_server(host, port, app, threaded=threaded, fd=listener.fileno())
+    signal.signal(signal.SIGTERM, _terminate_worker)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pre-forking launcher for the diagnostic apps.')
+    parser.add_argument('app', choices=sorted(APPS))
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--preload', dest='preload', action='store_true', default=None,
+                        help='load models in the parent and share them with workers')
+    parser.add_argument('--no-preload', dest='preload', action='store_false',
+                        help='load models in each worker instead')
+    parser.add_argument('--no-threads', action='store_true', help='serve one request at a time per worker')
+    parser.add_argument('--memory-report-interval', type=float, default=0,
+                        help='seconds between memory reports (0 = only on SIGUSR1)')
+    args = parser.parse_args()
+
+    module_names, default_port, preload_default = APPS[args.app]
+    port = args.port or default_port
+    # TensorFlow's runtime is not fork-safe, so brain loads per worker unless asked
+    use_preload = preload_default if args.preload is None else args.preload
+
+    # Split the cores between workers so their TensorFlow thread pools don't
+    # oversubscribe the machine (brain_model.configure_threads reads these)
+    os.environ.setdefault('TF_INTRA_OP_THREADS', str(max(1, (os.cpu_count() or 1) // args.workers)))
+    os.environ.setdefault('TF_INTER_OP_THREADS', '1')
+
+    # Workers merge their /metrics through snapshot files here (see metrics.py);
+    # start from an empty directory so an earlier run's counters aren't added in
+    metrics_dir = os.environ.setdefault('METRICS_DIR', tempfile.mkdtemp(prefix=f'metrics-{args.app}-'))
+    for path in glob.glob(os.path.join(metrics_dir, '*.json')):
+        os.remove(path)
+
+    listener = socket.create_server((args.host, port), backlog=128)
+    listener.set_inheritable(True)
+
+    app = None
+    if use_preload:
+        app = load_app(args.app, preload_models=True)
+        # Move everything loaded so far out of the collector's reach so
+        # workers don't write to (and un-share) those pages
+        gc.collect()
+        gc.freeze()
+
+    workers = {}        # pid -> slot
+    started = {}        # slot -> monotonic start time
+    quick_exits = {}    # slot -> consecutive quick exits
+    restarts = {}       # slot -> monotonic time to restart at
+
+    def spawn(slot):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                # Without --preload each worker loads (and warms up) its own models before serving
+                try:
+                    worker_app = app if app is not None else load_app(args.app, preload_models=True)
+                except Exception:
+                    traceback.print_exc()
+                    os._exit(EXIT_LOAD_FAILED)
+                run_worker(worker_app, listener, args.host, port, threaded=not args.no_threads)
+            finally:
+                os._exit(1)
+        workers[pid] = slot
+        started[slot] = time.monotonic()
+
+    def worker_exited(pid, status, slot):
+        code = os.waitstatus_to_exitcode(status)
+        reason = 'failed to load the app' if code == EXIT_LOAD_FAILED else f'exited with status {code}'
+        if time.monotonic() - started[slot] < QUICK_EXIT_SECONDS:
+            quick_exits[slot] = quick_exits.get(slot, 0) + 1
+        else:
+            quick_exits[slot] = 0
+
+        if quick_exits[slot] >= MAX_QUICK_EXITS:
+            print(f"Worker {pid} {reason}; giving up on slot {slot} after {quick_exits[slot]} quick exits",
+                  flush=True)
+            return
+        delay = 0.0
+        if quick_exits[slot]:
+            delay = min(RESTART_BACKOFF * 2 ** (quick_exits[slot] - 1), RESTART_BACKOFF_MAX)
+        print(f"Worker {pid} {reason}, restarting in {delay:.1f}s", flush=True)
+        restarts[slot] = time.monotonic() + delay
+
+    def report(*_):
+        print(memory_report(os.getpid(), sorted(workers)), flush=True)
+
+    def shutdown(*_):
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        sys.exit(0)
+
+    signal.signal(signal.SIGUSR1, report)
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    for slot in range(args.workers):
+        spawn(slot)
+    print(f"Serving {', '.join(module_names)} on {args.host}:{port} with {args.workers} workers "
+          f"({'preloaded' if use_preload else 'per-worker load'})", flush=True)
+
+    next_report = time.monotonic() + args.memory_report_interval
+    while True:
+        now = time.monotonic()
+        for slot, restart_at in list(restarts.items()):
+            if now >= restart_at:
+                del restarts[slot]
+                spawn(slot)
+
+        try:
+            flags = os.WNOHANG if args.memory_report_interval or restarts else 0
+            pid, status = os.waitpid(-1, flags)
+        except ChildProcessError:
+            if restarts:
+                time.sleep(0.5)
+                continue
+            print("No workers left; exiting", flush=True)
+            sys.exit(1)
+        except InterruptedError:
+            continue
+
+        if pid:
+            slot = workers.pop(pid, None)
+            if slot is not None:
+                worker_exited(pid, status, slot)
+            continue
+
+        if args.memory_report_interval and time.monotonic() >= next_report:
+            report()
+            next_report = time.monotonic() + args.memory_report_interval
+        time.sleep(0.5)
+
+
+if __name__ == '__main__':
+    main()
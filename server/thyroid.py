@@ -1,26 +1,62 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 import pandas as pd
 import numpy as np
 import pickle
 import os
+import io
 import json
-import google.generativeai as genai
+from concurrent.futures import ThreadPoolExecutor
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
 from sklearn.ensemble import RandomForestClassifier  # Added this import
+from llm_cache import ResponseCache
+from thyroid_assessment import get_assessment_model
+from forest_compiler import compile_forest
+from model_registry import registry
+from jobs import JobManager
+from llm_client import create_client
+from metrics import Metrics
+from audit import batch_digest, create_audit_log
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
-# Load the trained model
-model_path = 'model.pkl'
-with open(model_path, 'rb') as f:
-    model = pickle.load(f)
+# Per-stage latency, in-flight requests and cache ratios on /metrics
+metrics = Metrics('thyroid')
+metrics.instrument(app)
+
+# Prediction audit trail, written off the request path
+audit = create_audit_log('thyroid')
+
+# Input columns in the order the model was trained on
+THYROID_FEATURES = ['age', 'sex', 'TSH', 'T3', 'TT4', 'on_thyroxine', 'query_on_thyroxine',
+                    'on_antithyroid_medication', 'sick', 'pregnant', 'thyroid_surgery',
+                    'I131_treatment', 'query_hypothyroid', 'query_hyperthyroid', 'tumor', 'psych']
+
+class ThyroidClassifier:
+    """The model.pkl forest plus its compiled flat-array form and column order."""
+
+    def __init__(self, model):
+        self.model = model
+        self.features = THYROID_FEATURES
+        if getattr(model, 'feature_names_in_', None) is not None:
+            self.features = list(model.feature_names_in_)
+        # Evaluate the forest from flat arrays; falls back to sklearn if it isn't a plain forest
+        self.compiled = compile_forest(model)
 
-# Configure Gemini AI
-# You'll need to set your API key - for production, use environment variables
-# os.environ["GOOGLE_API_KEY"] = "your-api-key"  
-genai.configure(api_key="")
+    def predict(self, X):
+        """Predict thyroid classes for an (N, 16) float matrix in self.features order."""
+        if self.compiled is not None:
+            return self.compiled.predict(X)
+        return self.model.predict(pd.DataFrame(X, columns=self.features))
+
+def load_classifier(path):
+    with open(path, 'rb') as f:
+        return ThyroidClassifier(pickle.load(f))
+
+# Load the trained model on first use through the shared registry
+model_path = 'model.pkl'
+registry.register('thyroid', model_path, load_classifier)
 
 # Configure the model
 generation_config = {
@@ -37,13 +73,51 @@ safety_settings = {
     HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
 }
 
-def get_explanation(thyroid_class, patient_data):
-    """Generate an explanation of the thyroid condition using Gemini."""
-    model = genai.GenerativeModel(model_name="gemini-1.5-flash",
-                                 generation_config=generation_config,
-                                 safety_settings=safety_settings)
-    
-    # Create a prompt with the thyroid class and relevant patient data
+# Shared, rate-limited LLM client (set GEMINI_API_KEY; LLM_BACKEND=stub to run offline)
+llm = create_client("gemini-1.5-flash", generation_config=generation_config,
+                    safety_settings=safety_settings)
+
+# Run explanation and diet generation side by side
+llm_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('LLM_WORKERS', 8)),
+                                  thread_name_prefix='thyroid-llm')
+
+# Both prompts depend only on the predicted class, so cache responses per class
+LLM_CACHE_TTL = float(os.environ.get('LLM_CACHE_TTL', 7 * 24 * 3600))
+LLM_CACHE_SIZE = int(os.environ.get('LLM_CACHE_SIZE', 64))
+explanation_cache = ResponseCache(max_entries=LLM_CACHE_SIZE, ttl_seconds=LLM_CACHE_TTL,
+                                  persist_path=os.environ.get('THYROID_EXPLANATION_CACHE_PATH') or None)
+diet_cache = ResponseCache(max_entries=LLM_CACHE_SIZE, ttl_seconds=LLM_CACHE_TTL,
+                           persist_path=os.environ.get('DIET_CACHE_PATH') or None)
+
+# By default /api/predict returns immediately and the explanation and diet
+# arrive through a background job; ?mode=sync keeps the combined response
+# Job state goes to a SQLite file so any serve.py worker can answer a poll
+RESPONSE_MODE = os.environ.get('RESPONSE_MODE', 'async')
+jobs = JobManager(max_workers=int(os.environ.get('JOB_WORKERS', 8)), name='thyroid-jobs',
+                  store_path=os.environ.get('THYROID_JOB_STORE_PATH', 'thyroid_jobs.db') or None)
+
+EXPLANATION_FALLBACK = "<p>Unable to generate explanation at this time. Please consult with your healthcare provider for information about your condition.</p>"
+
+DIET_FALLBACK = {
+    "include": [
+        {"name": "Seafood", "reason": "Rich in iodine and selenium"},
+        {"name": "Fruits and vegetables", "reason": "Provide essential vitamins and antioxidants"},
+        {"name": "Lean proteins", "reason": "Support thyroid hormone production"},
+        {"name": "Whole grains", "reason": "Provide fiber and nutrients"},
+        {"name": "Nuts and seeds", "reason": "Contain healthy fats and minerals"}
+    ],
+    "avoid": [
+        {"name": "Processed foods", "reason": "May contain additives that interfere with thyroid function"},
+        {"name": "Excessive soy products", "reason": "May affect thyroid hormone absorption"},
+        {"name": "High-sugar foods", "reason": "Can contribute to inflammation"},
+        {"name": "Alcohol", "reason": "Can affect thyroid function"},
+        {"name": "Caffeine", "reason": "May interfere with medication absorption"}
+    ]
+}
+
+def generate_explanation(thyroid_class):
+    """Call Gemini for the condition explanation. Raises on failure."""
+    # Create a prompt with the thyroid class
     prompt = f"""
     As a medical expert, provide a clear, easy-to-understand explanation of the thyroid condition: {thyroid_class}.
     
@@ -57,19 +131,19 @@ def get_explanation(thyroid_class, patient_data):
     Keep your explanation under 300 words and make it understandable to someone without medical background.
     """
     
+    with metrics.stage('llm_explanation'):
+        return llm.generate(prompt)
+
+def get_explanation(thyroid_class, patient_data=None):
+    """Generate an explanation of the thyroid condition using Gemini."""
     try:
-        response = model.generate_content(prompt)
-        return response.text
+        return explanation_cache.get_or_create(str(thyroid_class), generate_explanation)
     except Exception as e:
         print(f"Error generating explanation: {e}")
-        return "<p>Unable to generate explanation at this time. Please consult with your healthcare provider for information about your condition.</p>"
+        return EXPLANATION_FALLBACK
 
-def get_diet_recommendations(thyroid_class):
-    """Generate dietary recommendations for the thyroid condition using Gemini."""
-    model = genai.GenerativeModel(model_name="gemini-1.5-flash",
-                                 generation_config=generation_config,
-                                 safety_settings=safety_settings)
-    
+def generate_diet_recommendations(thyroid_class):
+    """Call Gemini for diet recommendations and parse the JSON. Raises on failure."""
     prompt = f"""
     As a nutritionist specializing in thyroid health, provide dietary recommendations for someone with {thyroid_class}.
     
@@ -87,36 +161,32 @@ def get_diet_recommendations(thyroid_class):
     Ensure your recommendations are evidence-based and specifically tailored for {thyroid_class}.
     """
     
+    with metrics.stage('llm_diet'):
+        response_text = llm.generate(prompt)
+    # Parse the JSON response
+    # Clean the response to handle potential formatting issues
+    cleaned_response = response_text.strip()
+    if cleaned_response.startswith("```json"):
+        cleaned_response = cleaned_response[7:]
+    if cleaned_response.endswith("```"):
+        cleaned_response = cleaned_response[:-3]
+        
+    return json.loads(cleaned_response)
+
+def get_diet_recommendations(thyroid_class):
+    """Generate dietary recommendations for the thyroid condition using Gemini."""
     try:
-        response = model.generate_content(prompt)
-        # Parse the JSON response
-        # Clean the response to handle potential formatting issues
-        cleaned_response = response.text.strip()
-        if cleaned_response.startswith("```json"):
-            cleaned_response = cleaned_response[7:]
-        if cleaned_response.endswith("```"):
-            cleaned_response = cleaned_response[:-3]
-            
-        return json.loads(cleaned_response)
+        return diet_cache.get_or_create(str(thyroid_class), generate_diet_recommendations)
     except Exception as e:
         print(f"Error generating diet recommendations: {e}")
         # Return fallback recommendations if there's an error
-        return {
-            "include": [
-                {"name": "Seafood", "reason": "Rich in iodine and selenium"},
-                {"name": "Fruits and vegetables", "reason": "Provide essential vitamins and antioxidants"},
-                {"name": "Lean proteins", "reason": "Support thyroid hormone production"},
-                {"name": "Whole grains", "reason": "Provide fiber and nutrients"},
-                {"name": "Nuts and seeds", "reason": "Contain healthy fats and minerals"}
-            ],
-            "avoid": [
-                {"name": "Processed foods", "reason": "May contain additives that interfere with thyroid function"},
-                {"name": "Excessive soy products", "reason": "May affect thyroid hormone absorption"},
-                {"name": "High-sugar foods", "reason": "Can contribute to inflammation"},
-                {"name": "Alcohol", "reason": "Can affect thyroid function"},
-                {"name": "Caffeine", "reason": "May interfere with medication absorption"}
-            ]
-        }
+        return DIET_FALLBACK
+
+def get_explanation_and_diet(thyroid_class, patient_data=None):
+    """Generate the explanation and diet recommendations concurrently."""
+    explanation_future = llm_executor.submit(get_explanation, thyroid_class, patient_data)
+    diet_future = llm_executor.submit(get_diet_recommendations, thyroid_class)
+    return explanation_future.result(), diet_future.result()
 
 @app.route('/api/predict', methods=['POST'])
 def predict():
@@ -133,42 +203,45 @@ def predict():
             except:
                 return np.nan
         
-        # Convert to DataFrame with proper handling of empty strings
-        input_data = pd.DataFrame({
-            'age': [convert_value(data.get('age'))],
-            'sex': [convert_value(data.get('sex'))],
-            'TSH': [convert_value(data.get('TSH'))],
-            'T3': [convert_value(data.get('T3'))],
-            'TT4': [convert_value(data.get('TT4'))],
-            'on_thyroxine': [convert_value(data.get('on_thyroxine'))],
-            'query_on_thyroxine': [convert_value(data.get('query_on_thyroxine'))],
-            'on_antithyroid_medication': [convert_value(data.get('on_antithyroid_medication'))],
-            'sick': [convert_value(data.get('sick'))],
-            'pregnant': [convert_value(data.get('pregnant'))],
-            'thyroid_surgery': [convert_value(data.get('thyroid_surgery'))],
-            'I131_treatment': [convert_value(data.get('I131_treatment'))],
-            'query_hypothyroid': [convert_value(data.get('query_hypothyroid'))],
-            'query_hyperthyroid': [convert_value(data.get('query_hyperthyroid'))],
-            'tumor': [convert_value(data.get('tumor'))],
-            'psych': [convert_value(data.get('psych'))]
-        })
+        classifier = registry.get('thyroid')
         
-        # Print the input data for debugging
-        print("Input data:", input_data)
+        # Convert to a feature row with proper handling of empty strings
+        with metrics.stage('features'):
+            input_data = {name: convert_value(data.get(name)) for name in classifier.features}
+            X = np.array([[input_data[name] for name in classifier.features]], dtype=np.float64)
         
         # Make prediction
-        prediction = model.predict(input_data)
+        with metrics.stage('forest'):
+            prediction = classifier.predict(X)
         thyroid_class = prediction[0]
+        audit.record(endpoint='predict', inputs=input_data, prediction=thyroid_class,
+                     model_version=registry.version('thyroid'), timings=metrics.request_timings())
         
-        # Get explanation and diet recommendations
-        explanation = get_explanation(thyroid_class, input_data)
-        diet_recommendations = get_diet_recommendations(thyroid_class)
+        # Compatibility mode: wait for both generations and return everything at once
+        if request.args.get('mode', RESPONSE_MODE) == 'sync':
+            # Get explanation and diet recommendations in parallel
+            explanation, diet_recommendations = get_explanation_and_diet(thyroid_class, input_data)
+            
+            # Return the prediction along with explanations and recommendations
+            return jsonify({
+                'prediction': thyroid_class,
+                'explanation': explanation,
+                'dietRecommendations': diet_recommendations,
+                'success': True
+            })
         
-        # Return the prediction along with explanations and recommendations
+        # Return the prediction right away; the LLM text follows via the job
+        job_id = jobs.submit({
+            'explanation': lambda: get_explanation(thyroid_class),
+            'dietRecommendations': lambda: get_diet_recommendations(thyroid_class)
+        })
         return jsonify({
             'prediction': thyroid_class,
-            'explanation': explanation,
-            'dietRecommendations': diet_recommendations,
+            'explanation': None,
+            'dietRecommendations': None,
+            'jobId': job_id,
+            'jobUrl': f'/api/jobs/{job_id}',
+            'streamUrl': f'/api/jobs/{job_id}/stream',
             'success': True
         })
         
@@ -179,61 +252,116 @@ def predict():
             'success': False
         }), 500
 
-@app.route('/api/health', methods=['GET'])
-def health_check():
-    return jsonify({'status': 'healthy'})
+# Largest batch /api/predict_batch accepts in one request
+BATCH_MAX_ROWS = int(os.environ.get('BATCH_MAX_ROWS', 100000))
 
-class ThyroidAssessmentModel:
-    def __init__(self):
-        # Initialize a simple Random Forest Classifier
-        self.model = RandomForestClassifier(n_estimators=100, random_state=42)
-        
-        # For demonstration, we'll "train" it with some basic rules
-        # Symptoms are: fatigue, weight_change, cold_sensitivity, hair_loss, 
-        # dry_skin, mood_changes, neck_swelling, heart_rate_changes
-        
-        # Generate synthetic training data based on medical heuristics
-        # This is oversimplified and for demonstration only
-        np.random.seed(42)
-        X_train = np.random.rand(1000, 8)  # 8 features
-        
-        # Simplified rule: 
-        # - If 4+ symptoms have severity > 0.6, likely needs testing
-        # - If neck_swelling or multiple symptoms are severe, likely needs testing
-        y_train = np.zeros(1000)
-        for i in range(1000):
-            severe_symptoms = sum(X_train[i] > 0.6)
-            neck_swelling = X_train[i, 6] > 0.7
-            
-            if severe_symptoms >= 4 or neck_swelling or sum(X_train[i] > 0.8) >= 2:
-                y_train[i] = 1
-                
-        self.model.fit(X_train, y_train)
-    
-    def predict(self, symptoms):
-        # Convert symptoms dict to array in the correct order
-        features = np.array([[
-            symptoms.get('fatigue', 0),
-            symptoms.get('weight_change', 0),
-            symptoms.get('cold_sensitivity', 0),
-            symptoms.get('hair_loss', 0),
-            symptoms.get('dry_skin', 0),
-            symptoms.get('mood_changes', 0),
-            symptoms.get('neck_swelling', 0),
-            symptoms.get('heart_rate_changes', 0)
-        ]])
-        
-        # Get prediction and probability
-        prediction = self.model.predict(features)[0]
-        proba = self.model.predict_proba(features)[0]
-        
-        return {
-            'needs_testing': bool(prediction),
-            'confidence': float(proba[int(prediction)])
-        }
+def read_batch_frame():
+    """Read a batch as a DataFrame from a CSV upload or body, or JSON {column: [values]}."""
+    if 'file' in request.files:
+        return pd.read_csv(request.files['file'].stream)
+    if request.mimetype in ('text/csv', 'application/csv'):
+        return pd.read_csv(io.BytesIO(request.get_data()))
+
+    data = request.get_json()
+    if isinstance(data, dict) and isinstance(data.get('columns'), dict):
+        data = data['columns']
+    if not isinstance(data, dict):
+        raise ValueError('Expected CSV or a JSON object of column arrays')
+    return pd.DataFrame(data)
+
+def batch_features(frame, features):
+    """(N, len(features)) float matrix; empty, missing or non-numeric values become NaN."""
+    frame = frame.reindex(columns=features)
+    return frame.apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64)
+
+@app.route('/api/predict_batch', methods=['POST'])
+def predict_batch():
+    try:
+        with metrics.stage('batch_parse'):
+            frame = read_batch_frame()
+        if len(frame) == 0:
+            return jsonify({'error': 'No rows provided', 'success': False}), 400
+        if len(frame) > BATCH_MAX_ROWS:
+            return jsonify({'error': f'At most {BATCH_MAX_ROWS} rows per batch', 'success': False}), 413
+
+        classifier = registry.get('thyroid')
+        with metrics.stage('batch_features'):
+            X = batch_features(frame, classifier.features)
+        with metrics.stage('batch_forest'):
+            predictions = np.asarray(classifier.predict(X)).tolist()
+        audit.record(endpoint='predict_batch', features=classifier.features, inputs_digest=batch_digest(X),
+                     rows=len(X), predictions=predictions, model_version=registry.version('thyroid'),
+                     timings=metrics.request_timings())
+
+        # LLM text depends only on the class, so generate it once per distinct class
+        classes = list(dict.fromkeys(predictions))
+        id_column = request.args.get('id_column')
+        ids = frame[id_column].tolist() if id_column and id_column in frame else list(range(len(frame)))
+        rows = [{'id': row_id, 'prediction': prediction} for row_id, prediction in zip(ids, predictions)]
+
+        if request.args.get('mode', RESPONSE_MODE) == 'sync':
+            # Submit the leaf calls straight to the pool and wait here in the request
+            # thread; a pool worker must never block on work queued to the same pool
+            futures = {thyroid_class: (llm_executor.submit(get_explanation, thyroid_class),
+                                       llm_executor.submit(get_diet_recommendations, thyroid_class))
+                       for thyroid_class in classes}
+            results = {}
+            for thyroid_class, (explanation_future, diet_future) in futures.items():
+                results[str(thyroid_class)] = {'explanation': explanation_future.result(),
+                                               'dietRecommendations': diet_future.result()}
+
+            # ?expand=1 copies the shared class result into every row
+            if request.args.get('expand') == '1':
+                for row in rows:
+                    row.update(results[str(row['prediction'])])
 
-# Initialize the model
-thyroid_model = ThyroidAssessmentModel()
+            return jsonify({'rows': rows, 'classes': results, 'success': True})
+
+        # One job for the whole batch with an explanation and diet part per class
+        parts = {}
+        for thyroid_class in classes:
+            parts[f'explanation:{thyroid_class}'] = lambda c=thyroid_class: get_explanation(c)
+            parts[f'dietRecommendations:{thyroid_class}'] = lambda c=thyroid_class: get_diet_recommendations(c)
+        job_id = jobs.submit(parts)
+        return jsonify({
+            'rows': rows,
+            'classes': {str(thyroid_class): None for thyroid_class in classes},
+            'jobId': job_id,
+            'jobUrl': f'/api/jobs/{job_id}',
+            'streamUrl': f'/api/jobs/{job_id}/stream',
+            'success': True
+        })
+
+    except Exception as e:
+        print(f"Error in batch prediction: {str(e)}")
+        return jsonify({
+            'error': str(e),
+            'success': False
+        }), 500
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job', 'success': False}), 404
+    return jsonify(job.snapshot())
+
+@app.route('/api/jobs/<job_id>/stream', methods=['GET'])
+def stream_job(job_id):
+    if jobs.get(job_id) is None:
+        return jsonify({'error': 'Unknown or expired job', 'success': False}), 404
+    return Response(stream_with_context(jobs.stream(job_id)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+metrics.collect('explanation_cache', explanation_cache.stats)
+metrics.collect('diet_cache', diet_cache.stats)
+metrics.collect('llm', llm.stats)
+metrics.collect('registry', registry.stats)
+metrics.collect('audit', audit.stats)
+
+@app.route('/api/health', methods=['GET'])
+def health_check():
+    return jsonify({'status': 'healthy', 'models': registry.stats(), 'llm': llm.stats()})
 
 # Add this route to your Flask application
 @app.route('/api/assess', methods=['POST'])
@@ -259,8 +387,11 @@ def assess_symptoms():
             'heart_rate_changes': symptom_data.get('heart_rate_changes', 0)
         }
         
-        # Make prediction using the model
-        result = thyroid_model.predict(symptoms)
+        # Make prediction using the model (loaded from its artifact on first use)
+        with metrics.stage('assessment_forest'):
+            result = get_assessment_model().predict(symptoms)
+        audit.record(endpoint='assess', inputs=symptoms, result=dict(result),
+                     model_version=registry.version('thyroid_assessment'), timings=metrics.request_timings())
         
         # Add recommendations based on the prediction
         recommendation = ""
@@ -0,0 +1,148 @@
+"""
+Symptom-based thyroid assessment model.
+
+The forest is trained on synthetic data generated from simple rules. Instead
+of refitting it on every import, it is built once into a versioned artifact
+and loaded lazily at serve time. The artifact carries a
+fingerprint of the generation rules and seed; if they change, the model is
+rebuilt on next load.
+
+Build ahead of time with:
+    python thyroid_assessment.py
+"""
+import hashlib
+import json
+import os
+
+import joblib
+import numpy as np
+import sklearn
+from sklearn.ensemble import RandomForestClassifier
+
+from forest_compiler import CompiledForest
+from model_registry import registry
+
+ARTIFACT_VERSION = 1
+DEFAULT_ARTIFACT_PATH = 'thyroid_assessment.joblib'
+
+# Symptoms are: fatigue, weight_change, cold_sensitivity, hair_loss,
+# dry_skin, mood_changes, neck_swelling, heart_rate_changes
+SYMPTOMS = ['fatigue', 'weight_change', 'cold_sensitivity', 'hair_loss',
+            'dry_skin', 'mood_changes', 'neck_swelling', 'heart_rate_changes']
+
+# Everything that determines the fitted model; changing any of it triggers a rebuild
+TRAINING_CONFIG = {
+    'seed': 42,
+    'n_samples': 1000,
+    'n_estimators': 100,
+    'severe_threshold': 0.6,
+    'severe_count': 4,
+    'neck_swelling_threshold': 0.7,
+    'very_severe_threshold': 0.8,
+    'very_severe_count': 2,
+}
+
+
+def fingerprint(config=TRAINING_CONFIG):
+    payload = json.dumps({
+        'version': ARTIFACT_VERSION,
+        'config': config,
+        'symptoms': SYMPTOMS,
+        'sklearn': sklearn.__version__,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def generate_training_data(config=TRAINING_CONFIG):
+    """
+    Generate synthetic training data based on medical heuristics.
+    This is oversimplified and for demonstration only.
+    """
+    X_train = np.random.RandomState(config['seed']).rand(config['n_samples'], len(SYMPTOMS))
+
+    # Simplified rule:
+    # - If 4+ symptoms have severity > 0.6, likely needs testing
+    # - If neck_swelling or multiple symptoms are severe, likely needs testing
+    severe_symptoms = (X_train > config['severe_threshold']).sum(axis=1)
+    neck_swelling = X_train[:, SYMPTOMS.index('neck_swelling')] > config['neck_swelling_threshold']
+    very_severe = (X_train > config['very_severe_threshold']).sum(axis=1)
+
+    y_train = ((severe_symptoms >= config['severe_count'])
+               | neck_swelling
+               | (very_severe >= config['very_severe_count'])).astype(np.float64)
+    return X_train, y_train
+
+
+class ThyroidAssessmentModel:
+    def __init__(self, model=None):
+        if model is None:
+            model = self.train()
+        self.model = model
+        # Flat-array copy of the trees for fast single-row and batch evaluation
+        self.compiled = CompiledForest.from_sklearn(model)
+
+    @staticmethod
+    def train(config=TRAINING_CONFIG):
+        # Initialize a simple Random Forest Classifier
+        model = RandomForestClassifier(n_estimators=config['n_estimators'], random_state=config['seed'])
+        X_train, y_train = generate_training_data(config)
+        model.fit(X_train, y_train)
+        return model
+
+    @classmethod
+    def build(cls, path=DEFAULT_ARTIFACT_PATH):
+        """Train the model and write it to path with its fingerprint."""
+        model = cls.train()
+        # Write to a temp file first so concurrent loaders never see a partial artifact
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        joblib.dump({'fingerprint': fingerprint(), 'model': model}, tmp_path)
+        os.replace(tmp_path, path)
+        return cls(model)
+
+    @classmethod
+    def load(cls, path=DEFAULT_ARTIFACT_PATH):
+        """
+        Load the artifact, rebuilding it if it is missing or was built from
+        different rules, seed or library version.
+        """
+        if os.path.exists(path):
+            try:
+                # No mmap_mode: sklearn's Tree.__setstate__ copies the node arrays onto the heap anyway
+                artifact = joblib.load(path)
+                if artifact.get('fingerprint') == fingerprint():
+                    return cls(artifact['model'])
+                print(f"Assessment model artifact {path} is stale, rebuilding")
+            except Exception as e:
+                print(f"Error loading assessment model from {path}: {e}")
+        return cls.build(path)
+
+    def features(self, symptoms):
+        # Convert symptoms dict to array in the correct order
+        return np.array([[symptoms.get(name, 0) for name in SYMPTOMS]], dtype=np.float64)
+
+    def predict(self, symptoms):
+        features = self.features(symptoms)
+
+        # Get prediction and probability from a single pass over the trees
+        proba = self.compiled.predict_proba(features)[0]
+        prediction = int(np.argmax(proba))
+
+        return {
+            'needs_testing': bool(self.compiled.classes_[prediction]),
+            'confidence': float(proba[prediction])
+        }
+
+
+registry.register('thyroid_assessment',
+                  os.environ.get('THYROID_ASSESSMENT_PATH', DEFAULT_ARTIFACT_PATH),
+                  ThyroidAssessmentModel.load)
+
+
+def get_assessment_model():
+    """Return the shared assessment model, loading it on first use."""
+    return registry.get('thyroid_assessment')
+
+
+if __name__ == '__main__':
+    ThyroidAssessmentModel.build(DEFAULT_ARTIFACT_PATH)
+    print(f"Saved assessment model to {DEFAULT_ARTIFACT_PATH} (fingerprint {fingerprint()[:12]})")
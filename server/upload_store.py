@@ -0,0 +1,315 @@
+import glob
+import hashlib
+import io
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from PIL import Image
+
+from image_io import IMAGE_EXTENSIONS
+
+# Names the store writes itself: <sha256><ext>. Anything else in the folder is left alone.
+STORED_NAME = re.compile(r'^[0-9a-f]{64}(\.[a-z0-9]+)?$')
+
+THUMBNAIL_FOLDER = 'thumbs'
+# Only refresh a file's access time this often, to avoid a syscall per hit
+TOUCH_INTERVAL = 60.0
+# Once over max_bytes, a sweep evicts down to this fraction of it, so the
+# next size-triggered sweep is a good number of uploads away
+LOW_WATER_FRACTION = 0.9
+
+
+def content_hash(data):
+    """Hex SHA-256 of the upload bytes, used as its storage key."""
+    return hashlib.sha256(data).hexdigest()
+
+
+class UploadStore:
+    """
+    Content-addressed upload folder. Files are stored as <sha256><ext>, so the
+    same scan is only written once and different users' files can never
+    overwrite each other just because they share a filename.
+
+    The folder is capped by total bytes (max_bytes) and by time since last
+    use (max_age_seconds). Serving a file marks it used by bumping its access
+    time (the modification time stays the upload time, so Last-Modified is
+    stable). A sweep evicts least recently used files first; once the folder
+    is over max_bytes it evicts down to LOW_WATER_FRACTION of it. Access times live
+    on disk, so pre-forked workers sharing the folder agree on the LRU order.
+    Small JPEG previews are generated on demand under thumbs/ and removed
+    with their original.
+    """
+
+    def __init__(self, folder, max_bytes=None, max_age_seconds=None, sweep_interval=60.0):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_age = max_age_seconds
+        self.sweep_interval = sweep_interval
+        self.thumbnail_folder = os.path.join(folder, THUMBNAIL_FOLDER)
+        os.makedirs(self.thumbnail_folder, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._last_sweep = 0.0
+        self._bytes_since_sweep = 0
+        self.files = 0
+        self.total_bytes = 0
+        self.evictions = 0
+        self.maybe_sweep()
+
+    def name_for(self, digest, filename):
+        ext = os.path.splitext(filename or '')[1].lower()
+        if ext not in IMAGE_EXTENSIONS:
+            ext = ''
+        return f"{digest}{ext}"
+
+    def path_for(self, name):
+        return os.path.join(self.folder, name)
+
+    def put(self, data, name):
+        """Write data under name unless an identical file is already stored."""
+        path = self.path_for(name)
+        if os.path.exists(path):
+            self.touch(path)
+            return path
+        try:
+            # Write to a temp file first so readers never see a partial image
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"Error saving upload to {path}: {e}")
+            return path
+
+        with self._lock:
+            self._bytes_since_sweep += len(data)
+        self.maybe_sweep()
+        return path
+
+    def touch(self, path, stat=None):
+        """Mark a stored file as used now, keeping its modification time."""
+        try:
+            stat = stat or os.stat(path)
+            now = time.time()
+            if now - stat.st_atime >= TOUCH_INTERVAL:
+                os.utime(path, (now, stat.st_mtime))
+        except OSError:
+            pass
+
+    def maybe_sweep(self):
+        """Sweep if the interval has passed or recent writes may have crossed the byte cap."""
+        with self._lock:
+            due = time.monotonic() - self._last_sweep >= self.sweep_interval
+            if self.max_bytes:
+                due = due or self.total_bytes + self._bytes_since_sweep > self.max_bytes
+            if not due:
+                return
+            self._last_sweep = time.monotonic()
+            self._bytes_since_sweep = 0
+        self.sweep()
+
+    def sweep(self):
+        """Evict files older than max_age, then, if over max_bytes, least recently used files down to the low-water mark."""
+        entries = []
+        for entry in os.scandir(self.folder):
+            if entry.is_file() and STORED_NAME.match(entry.name):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((max(stat.st_atime, stat.st_mtime), stat.st_size, entry.name))
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        cutoff = time.time() - self.max_age if self.max_age else None
+        size_limit = None
+        if self.max_bytes is not None and total > self.max_bytes:
+            size_limit = self.max_bytes * LOW_WATER_FRACTION
+        kept = len(entries)
+        for last_used, size, name in entries:
+            over_age = cutoff is not None and last_used < cutoff
+            over_size = size_limit is not None and total > size_limit
+            if not over_age and not over_size:
+                break
+            self.remove(name)
+            total -= size
+            kept -= 1
+
+        with self._lock:
+            self.evictions += len(entries) - kept
+            self.files = kept
+            self.total_bytes = total
+
+    def remove(self, name):
+        stem = os.path.splitext(name)[0]
+        for path in [self.path_for(name)] + glob.glob(os.path.join(self.thumbnail_folder, f"{stem}_*.jpg")):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def thumbnail_for(self, name, size=128):
+        """Path to a cached JPEG preview of a stored file (at most size pixels a side), or None."""
+        source = self.path_for(name)
+        if not os.path.exists(source):
+            return None
+        stem = os.path.splitext(name)[0]
+        path = os.path.join(self.thumbnail_folder, f"{stem}_{size}.jpg")
+        if os.path.exists(path):
+            return path
+
+        with Image.open(source) as image:
+            image.draft('RGB', (size, size))
+            image = image.convert('RGB')
+            image.thumbnail((size, size))
+            buffer = io.BytesIO()
+            image.save(buffer, format='JPEG', quality=80, optimize=True)
+
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(buffer.getvalue())
+        os.replace(tmp_path, path)
+        return path
+
+    def stats(self):
+        with self._lock:
+            return {
+                'files': self.files,
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'max_age_seconds': self.max_age,
+                'evictions': self.evictions,
+            }
+
+
+class PredictionCache:
+    """
+    Persistent LRU cache from image hash to prediction, backed by SQLite.
+
+    Entries are namespaced by a model tag so results from an older model file
+    are never served after the model changes.
+
+    The database runs in WAL mode with synchronous=NORMAL, so a commit doesn't
+    wait on an fsync. Hits only note the access time in memory; the pending
+    last_used updates are written in one transaction every TOUCH_FLUSH_SIZE
+    hits or TOUCH_FLUSH_INTERVAL seconds, and before any eviction. Eviction
+    runs only once the row count passes max_entries, and then trims the
+    oldest rows down to 1% below it so the next eviction is some inserts away.
+    """
+
+    TOUCH_FLUSH_SIZE = 256
+    TOUCH_FLUSH_INTERVAL = 5.0
+
+    def __init__(self, db_path, max_entries=10000, model_tag=''):
+        self.db_path = db_path
+        self.max_entries = max(1, int(max_entries))
+        self.model_tag = model_tag
+        self._lock = threading.Lock()
+        self._conn = self._connect()
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS predictions ('
+            ' digest TEXT NOT NULL,'
+            ' model_tag TEXT NOT NULL,'
+            ' result TEXT NOT NULL,'
+            ' confidence REAL NOT NULL,'
+            ' explanation TEXT,'
+            ' last_used REAL NOT NULL,'
+            ' PRIMARY KEY (digest, model_tag))'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)')
+        self._conn.commit()
+        self._reset_state()
+        self.hits = 0
+        self.misses = 0
+
+        # SQLite connections must not be shared across fork
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _reset_state(self):
+        self._touched = {}  # (digest, model_tag) -> last access time not yet written
+        self._touches_flushed = time.monotonic()
+        # Upper bound on the row count; other processes may also insert, so
+        # it is re-read before evicting
+        self._entries = self._conn.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+
+    def _after_fork(self):
+        # Keep the parent's handle referenced so it isn't closed from the child
+        self._parent_conn = self._conn
+        self._lock = threading.Lock()
+        self._conn = self._connect()
+        self._reset_state()
+
+    def _flush_touches(self):
+        # Caller holds the lock and commits
+        if self._touched:
+            self._conn.executemany(
+                'UPDATE predictions SET last_used = ? WHERE digest = ? AND model_tag = ?',
+                [(used, digest, model_tag) for (digest, model_tag), used in self._touched.items()])
+            self._touched = {}
+        self._touches_flushed = time.monotonic()
+
+    def _evict(self):
+        # Caller holds the lock and commits
+        self._flush_touches()
+        self._entries = self._conn.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+        excess = self._entries - self.max_entries
+        if excess > 0:
+            excess += min(self.max_entries // 100, self.max_entries - 1)
+            self._conn.execute(
+                'DELETE FROM predictions WHERE rowid IN ('
+                ' SELECT rowid FROM predictions ORDER BY last_used LIMIT ?)',
+                (excess,))
+            self._entries -= excess
+
+    def get(self, digest, model_tag=None):
+        """Return (result, confidence, explanation) or None."""
+        model_tag = model_tag or self.model_tag
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT result, confidence, explanation FROM predictions WHERE digest = ? AND model_tag = ?',
+                (digest, model_tag)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._touched[(digest, model_tag)] = time.time()
+            if len(self._touched) >= self.TOUCH_FLUSH_SIZE or \
+                    time.monotonic() - self._touches_flushed >= self.TOUCH_FLUSH_INTERVAL:
+                self._flush_touches()
+                self._conn.commit()
+            return row
+
+    def set(self, digest, result, confidence, explanation=None, model_tag=None):
+        model_tag = model_tag or self.model_tag
+        with self._lock:
+            self._touched.pop((digest, model_tag), None)
+            self._conn.execute(
+                'INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?)',
+                (digest, model_tag, result, float(confidence), explanation, time.time()))
+            # Counts replacements too, which only makes eviction re-check sooner
+            self._entries += 1
+            if self._entries > self.max_entries:
+                self._evict()
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                'entries': entries,
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }